@@ -1,5 +1,6 @@
 import loopnet_config
 from loopnet_util import *
+import loopnet_scheduler as ls
 import sys
 import os
 import numpy as np
@@ -15,6 +16,11 @@ def help():
     print('The basic flow is to compute field lines, identify loop structures, pair those structures across timesteps, then build evolution trees for each structure\n')
     print('In terms of LoopNet functions, this would look like')
     print('  >> ln.generate_lines()\n  >> ln.find_loops()\n  >> ln.track_loops()\n  >> structures, loop_paths, risers = ln.synthesize()\n')
+    print('The first three steps can also be run as one pipeline, which overlaps the stages across files')
+    print('  >> ln.run_pipeline()\n  >> structures, loop_paths, risers = ln.synthesize()\n')
+    print("For faster CPU inference, export the networks once, check them against a held-out line_data file, then select a variant")
+    print("  >> ln.export_models(heldout='00001000')\n  >> ln.tweak_config('INFERENCE_VARIANT','qint8')\n")
+    print("Loop structures saved by older versions can be converted to the pickle-free store that is read lazily\n  >> ln.convert_structures(packed=True)\n")
 
     print('The outputs from LoopNet.synthesize() are ready to be used in your own analyses, but have somewhat complicated data structures\n')
     print('  structures: list of lists of tuples of numpy arrays.')
@@ -28,6 +34,7 @@ def help():
     print('  ex. the radial coordinates of the j-th loop in the k-th file would be structures[k][l][0][2,:]\n')
 
     print('  loop_paths: list of lists of lists of lists of structure indices. [Niter-1][Nloop][Nbranch][Nidx]')
+    print('       (a lazy view, which works out each branch only when it is indexed or iterated. len(loop_paths[k][l]) counts the branches without building them)')
     print('       layer 0: origin file index. refers to each file in order except the final one. length = len(FILE_NUMBERS) - 1')
     print('       layer 1: origin loop index. corresponds to loops in the origin file')
     print('       layer 2: branch index. corresponds to a particular path through the tree of candidate evolutions for the origin loop')
@@ -50,6 +57,9 @@ def help():
 It is possible that very short timesteps would allow small enough detection radii that the branch multiplicity would decrease, but this would \
 likely be very storage intensive in terms of the underlying 3D data.\n')
 
+    print('  Note: Setting LOOP_TRACKING_MODE to \'flow\' keeps only the links of one min-cost flow over all of FILE_NUMBERS, \
+with births, deaths, splits and merges priced by the LOOP_TRACKING_*_COST settings, so each loop has few branches.\n')
+
     print('  Note: Currently, LoopNet only attempts to read 3D Spherical data in a format designed for Rayleigh v. 1.0.1. \
 If you want to use LoopNet with another simulation code, you will have to adjust each module accordingly.\n')
     
@@ -107,17 +117,9 @@ class LoopNet:
         import loopnet_generate_lines as lgl
         file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
         Nmp = self.config['MULTITHREADING_NUM_PROCESSORS']
-        for k in range(int(np.ceil(len(file_list)/Nmp))):
-            jobs = []
-            for j in range(Nmp):
-                try:
-                    p = mp.Process(target=lgl.integrateLines, args=(file_list[k*Nmp+j],self.config))
-                    jobs.append(p)
-                    p.start()
-                except IndexError:
-                    print('Process {:d} not started: all jobs assigned.'.format(j))
-            for j in jobs: j.join()
-        print('All jobs completed.')
+        results = ls.runTasks(lgl.integrateLines,[(fname,self.config) for fname in file_list],Nmp,self.config['MULTITHREADING_MAX_TASKS_IN_FLIGHT'],names=file_list,verbose=self.config['VERBOSE'])
+        ls.reportTasks(results)
+        return results
 
     #use this to use the neural nets to identify loop structures from existing field lines
     def find_loops(self):
@@ -126,14 +128,11 @@ class LoopNet:
         import loopnet_find_loops as lfl
         file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
         Nmp = self.config['MULTITHREADING_NUM_PROCESSORS']
-        jobs = []
-        for fname in file_list:
-            p = mp.Process(target=lfl.worker, args=(fname,self.config,))
-            jobs.append(p)
-        for k in range(int(np.ceil(len(jobs)/Nmp))):
-            for j in jobs[Nmp*k:Nmp*(k+1)]: j.start()
-            for j in jobs[Nmp*k:Nmp*(k+1)]: j.join()
-        print('All jobs completed.')
+        server = self.start_inference(Nmp)
+        try: results = ls.runTasks(lfl.worker,[(fname,self.config) for fname in file_list],Nmp,self.config['MULTITHREADING_MAX_TASKS_IN_FLIGHT'],names=file_list,verbose=self.config['VERBOSE'],**self.inference_pool(server))
+        finally: self.stop_inference(server)
+        ls.reportTasks(results)
+        return results
 
     #use this to track the identified structures between time steps
     #note: tracking in loopnet is still only marginally functional
@@ -143,14 +142,81 @@ class LoopNet:
         import loopnet_track_loops as ltl
         file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
         Nmp = self.config['MULTITHREADING_NUM_PROCESSORS']
-        jobs = []
-        for k in range(len(file_list)-1):
-            p = mp.Process(target=ltl.worker, args=([file_list[k],file_list[k+1]],self.config,))
-            jobs.append(p)
-        for k in range(int(np.ceil(len(jobs)/Nmp))):
-            for j in jobs[Nmp*k:Nmp*(k+1)]: j.start()
-            for j in jobs[Nmp*k:Nmp*(k+1)]: j.join()
-        print('All jobs completed.')
+        #the snapshots are loaded in time order as the workers free up, each once, and handed to the workers pair by pair
+        results = ls.runStream(ltl.matchSnapshots,ltl.pairTasks(file_list,self.config),Nmp,self.config['MULTITHREADING_MAX_TASKS_IN_FLIGHT'],verbose=self.config['VERBOSE'])
+        #in flow mode the workers only save candidate links, and the links are chosen once every pair is done
+        if self.config['LOOP_TRACKING_MODE'] == 'flow' and all([res[1] == 0 for res in results]): results.append(('flow',)+ls.runTask(ltl.trackFlow,(file_list,self.config)))
+        ls.reportTasks(results)
+        return results
+
+    #use this to run generate_lines, find_loops and track_loops as one pipeline on a shared pool of workers
+    #loops are found in a file as soon as its field lines are written, and a pair of files is tracked as soon as both
+    #sets of structures are, so the stages overlap rather than each waiting on every file of the previous one
+    #leave out stages whose outputs already exist, e.g. stages=['find','track'] to reuse saved field lines
+    def run_pipeline(self,stages=['generate','find','track']):
+        path_vars = {'generate':['FIELD_LINES_PATH','SPHERICAL_DATA_PATH','FIELD_LINES_IMAGES_PATH'],
+                     'find':['LOOP_STRUCTURES_PATH','LOOP_STRUCTURES_IMAGES_PATH','FIELD_LINES_PATH','SPHERICAL_DATA_PATH'],
+                     'track':['LOOP_STRUCTURES_PATH','LOOP_TRACKING_PATH','SPHERICAL_DATA_PATH']}
+        for stage in stages:
+            if not stage in path_vars: raise ValueError('Unknown pipeline stage {:s}'.format(str(stage)))
+        if not self.check_paths(sorted(set([v for stage in stages for v in path_vars[stage]]))): return
+
+        import loopnet_generate_lines as lgl
+        import loopnet_find_loops as lfl
+        import loopnet_track_loops as ltl
+        file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
+        Nmp = self.config['MULTITHREADING_NUM_PROCESSORS']
+        #tasks are listed snapshot by snapshot, so that the scheduler favours finishing early snapshots over starting new ones
+        tasks = []
+        for k in range(len(file_list)):
+            fname = file_list[k]
+            if 'generate' in stages: tasks.append(('generate_'+fname,lgl.integrateLines,(fname,self.config),[]))
+            if 'find' in stages: tasks.append(('find_'+fname,lfl.worker,(fname,self.config),['generate_'+fname]*('generate' in stages)))
+            if 'track' in stages and k > 0:
+                pair = [file_list[k-1],fname]
+                tasks.append(('track_{:s}_to_{:s}'.format(*pair),ltl.worker,(pair,self.config),['find_'+f for f in pair]*('find' in stages)))
+        if 'track' in stages and self.config['LOOP_TRACKING_MODE'] == 'flow': tasks.append(('track_flow',ltl.trackFlow,(file_list,self.config),[t[0] for t in tasks if t[0].startswith('track_')]))
+        server = self.start_inference(Nmp) if 'find' in stages else None
+        try: results = ls.runGraph(tasks,Nmp,self.config['MULTITHREADING_MAX_TASKS_IN_FLIGHT'],verbose=self.config['VERBOSE'],**self.inference_pool(server))
+        finally: self.stop_inference(server)
+        ls.reportTasks(results)
+        return results
+
+    #starts the process serving idnet and segnet to the workers of a pool of Nmp, if INFERENCE_SERVER is set
+    #twice as many slots as workers are made, so that a pool replacing a broken one can still connect
+    def start_inference(self,Nmp):
+        if not self.config['INFERENCE_SERVER']: return None
+        import loopnet_inference as linf
+        return linf.startServer(self.config,2*max(1,Nmp))
+
+    #keyword arguments connecting the workers of a pool to the inference server, if there is one
+    def inference_pool(self,server):
+        if server is None: return {}
+        import loopnet_inference as linf
+        return {'initializer':linf.initClient,'initargs':server['initargs']}
+
+    def stop_inference(self,server):
+        if server is None: return
+        import loopnet_inference as linf
+        linf.stopServer(server)
+
+    #use this to write the TorchScript, int8 and bf16 variants of idnet and segnet that INFERENCE_VARIANT can select
+    #if heldout names a file number with saved field lines, the variants are also compared with the fp32 models on its lines
+    def export_models(self,heldout=None):
+        import loopnet_export as lx
+        written = lx.exportModels(self.config,verbose=self.config['VERBOSE'])
+        if heldout is None: return written
+        if not self.check_paths(['FIELD_LINES_PATH']): return written
+        fname = '{:s}{:s}_f{:s}.npy'.format(self.config['FIELD_LINES_PATH'],self.config['FIELD_LINES_PREFIX'],convertNumber(int(heldout)))
+        return lx.reportVariants(self.config,fname)
+
+    #use this to rewrite saved loop structures as pickle-free stores that are memory-mapped and read lazily
+    #packed=True puts the structures of every file in FILE_NUMBERS into a single store
+    def convert_structures(self,packed=False):
+        if not self.check_paths(['LOOP_STRUCTURES_PATH']): return
+        import loopnet_store as lst
+        file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
+        return lst.convertStructures(self.config['LOOP_STRUCTURES_PATH'],self.config['LOOP_STRUCTURES_PREFIX'],file_list,packed,self.config['LOOP_STRUCTURES_STORE_DTYPE'],self.config['VERBOSE'])
 
     #pulls everything together to output everything you need to do your own analysis
     #note: tracking in loopnet is still only marginally functional
@@ -158,6 +224,7 @@ class LoopNet:
         if not self.check_paths(['LOOP_STRUCTURES_PATH','LOOP_TRACKING_PATH','SPHERICAL_DATA_PATH']): return
 
         import loopnet_analyze as la
+        import loopnet_store as lst
         file_list = [convertNumber(int(x)) for x in parseList(self.config['FILE_NUMBERS'])]
         structure_pref = self.config['LOOP_STRUCTURES_PREFIX']
         structure_dir = self.config['LOOP_STRUCTURES_PATH']
@@ -173,7 +240,7 @@ class LoopNet:
 
         if verbose: print('Loading data...')
 
-        merged_structures = [np.load('{:s}{:s}_f{:s}.npy'.format(structure_dir,structure_pref,k),allow_pickle=True) for k in file_list]
+        merged_structures = [lst.loadStructures(structure_dir,structure_pref,k) for k in file_list]
         pairing_data = [np.load('{:s}{:s}_f{:s}_to_{:s}.npy'.format(tracking_dir,tracking_pref,file_list[k],file_list[k+1]),allow_pickle=True) for k in range(len(file_list)-1)]
         
         if verbose: print('Building evolution trees...')
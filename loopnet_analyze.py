@@ -22,40 +22,198 @@ def rectifyPhis(phis): #phis are modulo 2pi when coming from the integrator, mak
     if flatten: return phis[0,:]
     else: return phis
 
+#The successors of the structures of one timestep of pairing_data, as a CSR adjacency: the successors of structure l are
+#indices[indptr[l]:indptr[l+1]], in the order they were paired
+def pairingGraph(pairs):
+    lengths = np.array([len(p) for p in pairs],dtype=np.int64)
+    indptr = np.zeros(len(pairs)+1,dtype=np.int64)
+    indptr[1:] = np.cumsum(lengths)
+    indices = np.array([j for p in pairs for j in p],dtype=np.int64)
+    return indptr,indices
+
+#Fraction of the nodes of this_loop that differ from loop at the same time index, counting nodes past the end of loop as different
+def branchVariance(this_loop,loop):
+    n = min(len(this_loop),len(loop))
+    return (np.count_nonzero(np.array(this_loop[:n]) != np.array(loop[:n]))+len(this_loop)-n)/len(this_loop)
+
 # pairing_data is a list of lists of lists of structure indices [Niter-1][Nloop][Nmatch]
 # minvar is a fraction representing the minimum amount of variation a branch must meet to be considered distinct from previous branches
-# output is a list of lists of lists of arrays of structure indices [Niter-1][Nloop][Nbranch][Nidx]
+# output is a LoopPaths, indexed like a list of lists of lists of lists of structure indices [Niter-1][Nloop][Nbranch][Nidx]
 def build_loops_btf(pairing_data,minvar,verbose=False):
-    all_loops = [[[] for y in x] for x in pairing_data]
-    for k in np.arange(len(pairing_data)-1,-1,-1):
-        if verbose: print('  Working on timestep {:d}/{:d}'.format(k+1,len(pairing_data)))
-        for l in range(len(pairing_data[k])):
-            if pairing_data[k][l] == []: all_loops[k][l].append([l]) #if this is a dead end, mark it
-            else:
-                for j in range(len(pairing_data[k][l])):
-                    if k == len(pairing_data) - 1: all_loops[k][l].append([l,pairing_data[k][l][j]]) #if this is the crown of the tree, just write in the pairs we have
-                    else:
-                        for next_loop in all_loops[k+1][pairing_data[k][l][j]]: #find all the loop paths this one could lead into
-                            reject = False
-                            this_loop = [l]
-                            for i in next_loop: this_loop.append(i) #and tack them onto this loop
-                            for m in range(len(all_loops[k][l])):
-                                if not reject: 
-                                    reject = len(np.where(this_loop != all_loops[k][l][m])[0])/len(this_loop) < minvar #trash loops with less than minvar unique nodes
-                                    if reject and verbose: print('Rejecting loop ',this_loop,' for similarity to loop ',all_loops[k][l][m])
-                            if not reject: all_loops[k][l].append(this_loop) #then add this loop to the main list
-                            
-        if k < len(pairing_data)-1: # if we are past the first iteration, go back and pop any loops that are part of the ones we just found
-            for ln in range(len(all_loops[k+1])):
-                if len(all_loops[k+1][ln]) > 0:
-                    next_loop = all_loops[k+1][ln][0] #if any branch for this loop is captured, they all should be
-                    captured = False
-                    for l in range(len(all_loops[k])):
-                        for loop in all_loops[k][l]:
-                            if not captured: captured = loop[1:] == next_loop
-                    if captured: all_loops[k+1][ln] = []  #remove entries for loops that are just continuations of earlier structures
-
-    return all_loops
+    return LoopPaths(pairing_data,minvar,verbose)
+
+#The branches of every loop, following pairing_data forward in time, without holding them all in memory
+#A branch of structure l at timestep k follows the successors of l to a dead end or to the final file, and branches are
+#ordered by successor, depth first. Loops that are continuations of a loop at the previous timestep have no branches
+#Each timestep is kept as a CSR adjacency, and the number of branches of every structure is counted backwards in time,
+#so that any branch can be found from its index alone and the branches of a loop are produced one at a time as they are used
+#With minvar > 0 a branch is only kept if it differs by at least minvar from the kept branches before it, which depends on
+#every earlier branch, so the kept branches of a loop are worked out in full the first time they are used
+class LoopPaths:
+    def __init__(self,pairing_data,minvar=0,verbose=False):
+        self.minvar = minvar
+        self.verbose = verbose
+        self.nsteps = len(pairing_data)
+        self.graphs = [pairingGraph(pairs) for pairs in pairing_data]
+        self.sizes = [len(pairs) for pairs in pairing_data]
+        #predecessors, in the same CSR layout, of the structures of every timestep after the first
+        self.preds = [None]
+        for k in range(1,self.nsteps):
+            indptr,indices = self.graphs[k-1]
+            owner = np.repeat(np.arange(self.sizes[k-1]),np.diff(indptr))
+            order = np.argsort(indices,kind='stable')
+            rptr = np.zeros(self.sizes[k]+1,dtype=np.int64)
+            rptr[1:] = np.cumsum(np.bincount(indices,minlength=self.sizes[k])[:self.sizes[k]])
+            self.preds.append((rptr,owner[order]))
+        #counts[k][l] is the number of branches of structure l at timestep k, and offsets[k][e] the number of branches of
+        #its structure that come before the successor of edge e. these are python integers, as branch counts can outgrow int64
+        self.counts = [None]*(self.nsteps+1)
+        self.offsets = [None]*self.nsteps
+        nlast = int(np.max(self.graphs[-1][1]))+1 if self.nsteps > 0 and len(self.graphs[-1][1]) > 0 else 0
+        self.counts[self.nsteps] = np.ones(nlast,dtype=object)
+        for k in np.arange(self.nsteps-1,-1,-1):
+            if verbose: print('  Counting branches at timestep {:d}/{:d}'.format(k+1,self.nsteps))
+            indptr,indices = self.graphs[k]
+            cums = np.zeros(len(indices)+1,dtype=object)
+            cums[1:] = np.cumsum(self.counts[k+1][indices])
+            counts = cums[indptr[1:]]-cums[indptr[:-1]]
+            counts[indptr[1:] == indptr[:-1]] = 1
+            self.counts[k] = counts
+            self.offsets[k] = cums[:-1]-cums[np.repeat(indptr[:-1],np.diff(indptr))]
+        self.kept = {}
+        #the last branch found by index, so that walking one branch point by point as loop_paths[k][l][b][t] finds it once
+        self.last = ((None,None,None),None)
+
+    def __len__(self):
+        return self.nsteps
+
+    def __getitem__(self,k):
+        if k < 0: k += self.nsteps
+        if k < 0 or k >= self.nsteps: raise IndexError('timestep index {:d} out of range'.format(k))
+        return TimestepPaths(self,k)
+
+    def __iter__(self):
+        for k in range(len(self)): yield self[k]
+
+    def successors(self,k,l):
+        if k >= self.nsteps: return self.graphs[0][1][:0]
+        indptr,indices = self.graphs[k]
+        return indices[indptr[l]:indptr[l+1]]
+
+    #True if structure l at timestep k continues a branch of a loop at timestep k-1, so that it has no branches of its own
+    def captured(self,k,l):
+        if k == 0: return False
+        rptr,owner = self.preds[k]
+        if self.minvar <= 0: return rptr[l+1] > rptr[l]
+        first = self.keptBranches(k,l)[0]
+        for p in owner[rptr[l]:rptr[l+1]]:
+            if [int(p)]+first in self.keptBranches(k-1,p): return True
+        return False
+
+    #Number of branches of structure l at timestep k
+    def count(self,k,l):
+        if self.captured(k,l): return 0
+        if self.minvar > 0: return len(self.keptBranches(k,l))
+        return int(self.counts[k][l])
+
+    #Branch b of structure l at timestep k, found by walking down the branch counts
+    def branch(self,k,l,b):
+        if self.minvar > 0: return list(self.keptBranches(k,l)[b])
+        key = (int(k),int(l),int(b))
+        if self.last[0] == key: return self.last[1]
+        path = [int(l)]
+        for t in range(k,self.nsteps):
+            indptr,indices = self.graphs[t]
+            if indptr[l] == indptr[l+1]: break
+            starts = self.offsets[t][indptr[l]:indptr[l+1]]
+            e = np.searchsorted(starts,b,side='right')-1
+            b -= starts[e]
+            l = indices[indptr[l]+e]
+            path.append(int(l))
+        self.last = (key,path)
+        return path
+
+    #Generates the branches of structure l at timestep k in order, depth first
+    def branches(self,k,l):
+        if self.minvar > 0:
+            for loop in self.keptBranches(k,l): yield list(loop)
+            return
+        path = [int(l)]
+        if len(self.successors(k,l)) == 0:
+            yield path
+            return
+        stack = [iter(self.successors(k,l))]
+        while len(stack) > 0:
+            j = next(stack[-1],None)
+            if j is None:
+                stack.pop()
+                path.pop()
+                continue
+            path.append(int(j))
+            if len(self.successors(k+len(path)-1,j)) == 0:
+                yield list(path)
+                path.pop()
+            else: stack.append(iter(self.successors(k+len(path)-1,j)))
+
+    #The branches of structure l at timestep k that differ by at least minvar from every branch kept before them
+    def keptBranches(self,k,l):
+        key = (int(k),int(l))
+        if key in self.kept: return self.kept[key]
+        succ = self.successors(k,l)
+        if len(succ) == 0: loops = [[int(l)]]
+        elif k == self.nsteps-1: loops = [[int(l),int(j)] for j in succ]
+        else:
+            loops = []
+            for j in succ:
+                for next_loop in self.keptBranches(k+1,j):
+                    this_loop = [int(l)]+next_loop
+                    reject = False
+                    for loop in loops:
+                        reject = branchVariance(this_loop,loop) < self.minvar #trash loops with less than minvar unique nodes
+                        if reject:
+                            if self.verbose: print('Rejecting loop ',this_loop,' for similarity to loop ',loop)
+                            break
+                    if not reject: loops.append(this_loop)
+        self.kept[key] = loops
+        return loops
+
+#The loops of one timestep of a LoopPaths
+class TimestepPaths:
+    def __init__(self,paths,k):
+        self.paths = paths
+        self.k = k
+
+    def __len__(self):
+        return self.paths.sizes[self.k]
+
+    def __getitem__(self,l):
+        if l < 0: l += len(self)
+        if l < 0 or l >= len(self): raise IndexError('loop index {:d} out of range'.format(l))
+        return BranchList(self.paths,self.k,l)
+
+    def __iter__(self):
+        for l in range(len(self)): yield self[l]
+
+#The branches of one loop of a LoopPaths. Indexing gives a branch as a list of structure indices, one per time index
+class BranchList:
+    def __init__(self,paths,k,l):
+        self.paths = paths
+        self.k = k
+        self.l = l
+
+    def __len__(self):
+        return self.paths.count(self.k,self.l)
+
+    def __getitem__(self,b):
+        if isinstance(b,slice): return [self[j] for j in range(*b.indices(len(self)))]
+        n = self.paths.count(self.k,self.l)
+        if b < 0: b += n
+        if b < 0 or b >= n: raise IndexError('branch index {:d} out of range'.format(b))
+        return self.paths.branch(self.k,self.l,b)
+
+    def __iter__(self):
+        if self.paths.captured(self.k,self.l): return
+        yield from self.paths.branches(self.k,self.l)
 
 def plot_rise(fname,merged_structures,loop_paths,rstar,dt=1,contour=None,verbose=False):
     risers = []
@@ -65,14 +223,15 @@ def plot_rise(fname,merged_structures,loop_paths,rstar,dt=1,contour=None,verbose
     for k in range(len(loop_paths)): #k is starting time index
         for j in range(len(loop_paths[k])): #j is starting structure index
             for b in range(len(loop_paths[k][j])): #b is a branch index
-                times = np.arange(k,k+len(loop_paths[k][j][b]))*dt
-                rads = np.zeros(len(loop_paths[k][j][b]))
-                for t in range(len(loop_paths[k][j][b])): #t+k is a time index
-                    loop_rads = merged_structures[k+t][loop_paths[k][j][b][t]][0][2,:]/rstar
+                path = loop_paths[k][j][b]
+                times = np.arange(k,k+len(path))*dt
+                rads = np.zeros(len(path))
+                for t in range(len(path)): #t+k is a time index
+                    loop_rads = merged_structures[k+t][path[t]][0][2,:]/rstar
                     rads[t] = np.max(loop_rads)   #maximum radius
                 for t in [np.argmax(rads)]:
-                    peakind = np.argmax(merged_structures[k+t][loop_paths[k][j][b][t]][0][2,:])
-                    phis = rectifyPhis(merged_structures[k+t][loop_paths[k][j][b][t]][0][0,:])
+                    peakind = np.argmax(merged_structures[k+t][path[t]][0][2,:])
+                    phis = rectifyPhis(merged_structures[k+t][path[t]][0][0,:])
                     pospol = np.sign(phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])]) == 1
                 if np.max(rads) > rads[0] or pospol:
                     weight = np.min([np.max([0.0001,np.max(rads)-rads[0]])/.15,1])
@@ -81,9 +240,9 @@ def plot_rise(fname,merged_structures,loop_paths,rstar,dt=1,contour=None,verbose
                         risers.append([k,j,b,np.argmax(rads)])
                         if verbose: 
                             print('  Instant {:d}, structure {:d}, branch {:d} shows good rise, rmax-r0 = {:.2f}'.format(k,j,b,np.max(rads)-rads[0]))
-                            print('  The loop path is ',loop_paths[k][j][b],' corresponding to structures ')
-                            for t in range(len(loop_paths[k][j][b])):
-                                print('Time {:d} structure {:d} = '.format(k+t,loop_paths[k][j][b][t]),structures[k+t][loop_paths[k][j][b][t]])
+                            print('  The loop path is ',path,' corresponding to structures ')
+                            for t in range(len(path)):
+                                print('Time {:d} structure {:d} = '.format(k+t,path[t]),structures[k+t][path[t]])
                     plt.plot(times,rads,color=[weight**2,0,0,weight**2],marker='.')
     if not contour is None: plt.contour(contour[0]*np.max(times)/np.max(contour[1]),contour[1],contour[2],contour[3],colors=contour[4])
     plt.gca().xaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator(10))
@@ -103,23 +262,25 @@ def plot_latitude(fname,merged_structures,loop_paths,dt=1,minr=0,risers=None,con
         for k in range(len(loop_paths)): #k is starting time index
             for j in range(len(loop_paths[k])): #j is starting structure index
                 for b in range(len(loop_paths[k][j])): #b is a branch index
-                    for t in range(len(loop_paths[k][j][b])): #t+k is a time index
-                        rads = merged_structures[k+t][loop_paths[k][j][b][t]][0][2,:]
+                    path = loop_paths[k][j][b]
+                    for t in range(len(path)): #t+k is a time index
+                        rads = merged_structures[k+t][path[t]][0][2,:]
                         if np.max(rads) > minr:
                             times.append(dt*(k+t))
                             peakind = np.argmax(rads)
-                            lats = merged_structures[k+t][loop_paths[k][j][b][t]][0][1,:]
-                            phis = rectifyPhis(merged_structures[k+t][loop_paths[k][j][b][t]][0][0,:])
+                            lats = merged_structures[k+t][path[t]][0][1,:]
+                            phis = rectifyPhis(merged_structures[k+t][path[t]][0][0,:])
                             polarity = np.sign(phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])]) #dphi/ds matches the sign of Bphi
                             plt.plot(times[-1],90-180/np.pi*lats[peakind],'.',color=[(1+polarity)/2,0,(1-polarity)/2])
     else:
         for r in risers:
-            rads = merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][2,:]
+            path = loop_paths[r[0]][r[1]][r[2]]
+            rads = merged_structures[r[0]+r[3]][path[r[3]]][0][2,:]
             if np.max(rads) > minr:
                 times.append(dt*(r[0]+r[3]))
                 peakind = np.argmax(rads)
-                lats = merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][1,:]
-                phis = rectifyPhis(merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][0,:])
+                lats = merged_structures[r[0]+r[3]][path[r[3]]][0][1,:]
+                phis = rectifyPhis(merged_structures[r[0]+r[3]][path[r[3]]][0][0,:])
                 polarity = np.sign(phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])]) #dphi/ds matches the sign of Bphi
                 plt.plot(times[-1],90-180/np.pi*lats[peakind],'.',color=[(1+polarity)/2,0,(1-polarity)/2])
     if not contour is None: plt.contour(contour[0]*np.max(times)/np.max(contour[0]),contour[1],contour[2],contour[3],colors=contour[4])
@@ -142,23 +303,25 @@ def plot_longitude(fname,merged_structures,loop_paths,dt=1,minr=0,risers=None,co
         for k in range(len(loop_paths)): #k is starting time index
             for j in range(len(loop_paths[k])): #j is starting structure index
                 for b in range(len(loop_paths[k][j])): #b is a branch index
-                    for t in range(len(loop_paths[k][j][b])): #t+k is a time index
-                        rads = merged_structures[k+t][loop_paths[k][j][b][t]][0][2,:]
+                    path = loop_paths[k][j][b]
+                    for t in range(len(path)): #t+k is a time index
+                        rads = merged_structures[k+t][path[t]][0][2,:]
                         if np.max(rads) > minr:
                             times.append(dt*(k+t))
                             peakind = np.argmax(rads)
-                            allphis.append(merged_structures[k+t][loop_paths[k][j][b][t]][0][0,:][peakind]*180/np.pi)
-                            phis = 180/np.pi*rectifyPhis(merged_structures[k+t][loop_paths[k][j][b][t]][0][0,:])+rotate
+                            allphis.append(merged_structures[k+t][path[t]][0][0,:][peakind]*180/np.pi)
+                            phis = 180/np.pi*rectifyPhis(merged_structures[k+t][path[t]][0][0,:])+rotate
                             allrphis.append(phis[peakind])
                             polarity = np.sign(phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])]) #dphi/ds matches the sign of Bphi
                             plt.plot(times[-1],phis[peakind]%360,'.',color=[(1+polarity)/2,0,(1-polarity)/2])
     else:
         for r in risers:
-            rads = merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][2,:]
+            path = loop_paths[r[0]][r[1]][r[2]]
+            rads = merged_structures[r[0]+r[3]][path[r[3]]][0][2,:]
             if np.max(rads) > minr:
                 times.append(dt*(r[0]+r[3]))
                 peakind = np.argmax(rads)
-                phis = 180/np.pi*rectifyPhis(merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][0,:])+rotate
+                phis = 180/np.pi*rectifyPhis(merged_structures[r[0]+r[3]][path[r[3]]][0][0,:])+rotate
                 polarity = np.sign(phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])]) #dphi/ds matches the sign of Bphi
                 plt.plot(times[-1],phis[peakind]%360,'.',color=[(1+polarity)/2,0,(1-polarity)/2])
     if not contour is None: plt.contour(contour[0]*np.max(times)/np.max(contour[0]),(contour[1]+rotate) % 360,contour[2],contour[3],colors=contour[4])
@@ -184,13 +347,14 @@ def plot_joyslaw(fname,merged_structures,loop_paths,dt=1,minr=0,risers=None,cont
         for k in range(len(loop_paths)): #k is starting time index
             for j in range(len(loop_paths[k])): #j is starting structure index
                 for b in range(len(loop_paths[k][j])): #b is a branch index
-                    for t in range(len(loop_paths[k][j][b])): #t+k is a time index
-                        rads = merged_structures[k+t][loop_paths[k][j][b][t]][0][2,:]
+                    path = loop_paths[k][j][b]
+                    for t in range(len(path)): #t+k is a time index
+                        rads = merged_structures[k+t][path[t]][0][2,:]
                         if np.max(rads) > minr:
                             times.append(dt*(k+t))
                             peakind = np.argmax(rads)
-                            lats = 90-180/np.pi*merged_structures[k+t][loop_paths[k][j][b][t]][0][1,:]
-                            phis = 180/np.pi*rectifyPhis(merged_structures[k+t][loop_paths[k][j][b][t]][0][0,:])
+                            lats = 90-180/np.pi*merged_structures[k+t][path[t]][0][1,:]
+                            phis = 180/np.pi*rectifyPhis(merged_structures[k+t][path[t]][0][0,:])
                             dphi = phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])] #dphi/ds matches the sign of Bphi
                             dtheta = lats[np.min([len(lats)-1,peakind+10])]-lats[np.max([0,peakind-10])]
                             angle = np.arctan(dtheta/dphi)*180/np.pi
@@ -200,12 +364,13 @@ def plot_joyslaw(fname,merged_structures,loop_paths,dt=1,minr=0,risers=None,cont
                                 all_angs.append(angle)
     else:
         for r in risers:
-            rads = merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][2,:]
+            path = loop_paths[r[0]][r[1]][r[2]]
+            rads = merged_structures[r[0]+r[3]][path[r[3]]][0][2,:]
             if np.max(rads) > minr:
                 times.append(dt*(r[0]+r[3]))
                 peakind = np.argmax(rads)
-                lats = 90-180/np.pi*merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][1,:]
-                phis = 180/np.pi*rectifyPhis(merged_structures[r[0]+r[3]][loop_paths[r[0]][r[1]][r[2]][r[3]]][0][0,:])
+                lats = 90-180/np.pi*merged_structures[r[0]+r[3]][path[r[3]]][0][1,:]
+                phis = 180/np.pi*rectifyPhis(merged_structures[r[0]+r[3]][path[r[3]]][0][0,:])
                 dphi = phis[np.min([len(phis)-1,peakind+10])]-phis[np.max([0,peakind-10])] #dphi/ds matches the sign of Bphi
                 dtheta = lats[np.min([len(lats)-1,peakind+10])]-lats[np.max([0,peakind-10])]
                 angle = np.arctan(dtheta/dphi)*180/np.pi
@@ -37,6 +37,8 @@ def init():
     # Multithreading controls
     #-----------------------------------------------------------------------
     config['MULTITHREADING_NUM_PROCESSORS'] = 1 #number of cpu cores available
+    config['MULTITHREADING_MAX_TASKS_IN_FLIGHT'] = 0 #maximum number of files (or file pairs) handed to the worker pool at once. 0 allows two per processor
+    config['MULTITHREADING_WORKERS_PER_FILE'] = 1 #number of worker processes sharing the work within a single file, reading its fields from shared memory (field lines in generate_lines, structures in find_loops). 1 to work serially
     config['MULTITHREADING_NUM_GPU'] = 1 #number of cuda cores available for gpu-based segnet training
     config['MULTITHREADING_HOST_IP'] = '127.0.0.1' #host ip for gpu-based segnet training
     config['MULTITHREADING_HOST_PORT'] = '29500' #port number for gpu-based segnet training
@@ -60,6 +62,15 @@ def init():
     config['SEGNET_LOOP_CSEQUENCES'] = [] #sequences of segnet class numbers which represent a loop when trimming off the outermost elements. MODEL SPECIFIC
 
 
+    #-----------------------------------------------------------------------
+    # Network inference controls
+    #-----------------------------------------------------------------------
+    config['INFERENCE_BATCH_SIZE'] = 256 #number of field lines passed through idnet or segnet at once when identifying and segmenting loops
+    config['INFERENCE_VARIANT'] = 'fp32' #'fp32' runs the saved models as they are, while 'script', 'qint8' and 'bf16' run the faster CPU variants written by ln.export_models()
+    config['INFERENCE_SERVER'] = True #if True, find_loops loads both networks once in a separate process that serves every worker, otherwise each worker process loads its own copy once
+    config['INFERENCE_SERVER_TIMEOUT'] = 0 #seconds a worker waits for the inference server to answer before failing its file, 0 to wait indefinitely
+
+
     #-----------------------------------------------------------------------
     # Field line generation controls
     #-----------------------------------------------------------------------
@@ -72,13 +83,21 @@ def init():
     config['FIELD_LINE_INTEGRATION_ORDER'] = 'fwd' #fwd, back, or fab (front and back)
     config['NUM_FIELD_LINES'] = 1000 #number of field lines to generate at each iteration
     config['FIELD_LINE_INITIAL_NORMS'] = [config['STELLAR_RADIUS'],config['STELLAR_RADIUS'],5e2,1e4,3e4,3,5] #r_cyl,z_cyl,v_r,B_r,B_H,S-<S>,log(beta)
+    config['FIELD_LINE_SMOOTHED_ENTROPY'] = False #precompute the local mean <S> once per file as a smoothed 3D field instead of sampling it around every point of every line. this changes the S-<S> feature seen by the trained networks, so check it with FIELD_LINE_ENTROPY_CHECK_POINTS first
+    config['FIELD_LINE_SHARD_SIZE'] = 50 #number of field lines seeded from each independent random stream. changing this changes which lines are drawn
+    config['FIELD_LINE_RANDOM_SEED'] = None #integer seed for the field line seeds, giving the same lines for any number of workers. None to seed from the clock
+    config['FIELD_LINE_ENTROPY_CHECK_POINTS'] = 0 #number of random line points per file on which to compare the smoothed <S> against the per-point local average. 0 to skip the check
 
 
     #-----------------------------------------------------------------------
     # Loop structure finding controls
     #-----------------------------------------------------------------------
     config['LOOP_STRUCTURES_PREFIX'] = 'loop_structures' #filename prefix for data on segmented and merged loop structures
+    config['LOOP_STRUCTURES_FORMAT'] = 'store' #'store' saves structures as pickle-free .npz files that are memory-mapped when read, 'npy' as the object arrays of older versions. either can be read
+    config['LOOP_STRUCTURES_STORE_DTYPE'] = 'float64' #precision of the centerlines and girths in a store. 'float32' halves its size
     config['LOOP_STRUCTURES_NUM_VOLUME_LINES'] = 30 #number of additional lines to integrate around a line core to probe the coherent boundaries of the structures
+    config['LOOP_STRUCTURES_VOLUME_BATCH_SIZE'] = 16 #number of candidate volume line seeds integrated together. only affects speed, the lines kept are the same for any value
+    config['LOOP_STRUCTURES_RANDOM_SEED'] = None #seed for the volume line seeds, each structure drawing from its own stream so the results do not depend on MULTITHREADING_WORKERS_PER_FILE. None uses the time
     config['LOOP_STRUCTURES_LINE_SEED_RADIUS'] = 0.03 #fractional radius around line origin within which to initialize volume lines
     config['LOOP_STRUCTURES_RADIUS_TOLERANCE'] = 2 #maximum distance in multiples of rlines to be considered part of the same structure
     config['LOOP_STRUCTURES_PROXIMITY_THRESHOLD'] = 0.5 #fraction of two lines which must be within the tolerance radius to be considered the same structure
@@ -91,10 +110,16 @@ def init():
     # Loop structure tracking controls
     #-----------------------------------------------------------------------
     config['LOOP_TRACKING_PREFIX'] = 'loop_pairings' #filename prefix for loop pairing lists from one iteration to the next
+    config['LOOP_TRACKING_PROFILE_PREFIX'] = 'vphi_profile' #filename prefix for the azimuthal mean v_phi of each file, computed once and reused to drift structures
     config['LOOP_TRACKING_MIN_BRANCH_VARIANCE'] = 0 #minimum fraction of nodes in a branch that must be different from previous branches for the branch to be kept
     config['LOOP_TRACKING_RADIUS_TOLERANCE'] = 0.10 #maximum distance as a fraction of rstar to be considered part of the same structure
     config['LOOP_TRACKING_PROXIMITY_THRESHOLD'] = 0.6 #minimum fraction of two lines which must be within the tolerance radius to be considered part of the same structure
     config['LOOP_TRACKING_MAX_MATCH'] = 100 #maximum number of structures in the next iteration which can match with each structure in this iteration.
+    config['LOOP_TRACKING_MODE'] = 'branch' #'branch' keeps every overlapping successor and synthesize enumerates every branch, 'flow' keeps only the links of one min-cost flow over the whole sequence
+    config['LOOP_TRACKING_BIRTH_COST'] = 1.0 #flow mode: cost of starting a trajectory. link costs are the mean distance between matched centerlines in units of rstar*LOOP_TRACKING_RADIUS_TOLERANCE
+    config['LOOP_TRACKING_DEATH_COST'] = 1.0 #flow mode: cost of ending a trajectory
+    config['LOOP_TRACKING_SPLIT_COST'] = 0.5 #flow mode: cost of each extra successor of a structure. splits only happen if this plus the link cost is below LOOP_TRACKING_BIRTH_COST
+    config['LOOP_TRACKING_MERGE_COST'] = 0.5 #flow mode: cost of each extra predecessor of a structure. merges only happen if this plus the link cost is below LOOP_TRACKING_DEATH_COST
     config['SPHERICAL_DATA_TIMESTEP'] = 1000. #simulation timestep in seconds, will be multiplied by file numbers to estimate evolution time-scales
         
 
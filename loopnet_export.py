@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import time
+import copy
+import loopnet_inference as linf
+import loopnet_features as lf
+
+#Variants written by exportModels, all of them TorchScript models for CPU inference
+#  script: the fp32 models, traced and frozen
+#  qint8: the Linear layers dynamically quantized to int8. only idnet has any, so the segnet variant is the same as script
+#  bf16: weights and activations in bfloat16, with float32 inputs and outputs
+VARIANTS = ['script','qint8','bf16']
+
+#Runs a model in bfloat16 behind a float32 interface, so the exported variants are interchangeable
+class Bfloat16Net(nn.Module):
+    def __init__(self,net):
+        super(Bfloat16Net, self).__init__()
+        self.net = net.to(torch.bfloat16)
+
+    def forward(self, x):
+        return self.net(x.to(torch.bfloat16)).float()
+
+#Builds the variant of an eval mode model and traces it on example, an input batch
+def buildVariant(net,variant,example):
+    net = copy.deepcopy(net).eval()
+    if variant == 'qint8': net = torch.ao.quantization.quantize_dynamic(net,{nn.Linear},dtype=torch.qint8)
+    elif variant == 'bf16': net = Bfloat16Net(net).eval()
+    elif not variant == 'script': raise ValueError('Unknown inference variant {:s}'.format(str(variant)))
+    with torch.inference_mode(): return torch.jit.freeze(torch.jit.trace(net,example))
+
+#Exports every variant of idnet and the segnet encoder named in config, next to the saved models (see linf.variantPath)
+#returns the list of files written
+def exportModels(config,variants=VARIANTS,verbose=True):
+    fp32 = dict(config)
+    fp32['INFERENCE_VARIANT'] = 'fp32'
+    idnet,segnet = linf.loadModels(fp32)
+    npoints = config['FIELD_LINE_INTEGRATION_STEPS']+1
+    examples = [torch.rand((2,11-len(config['IDNET_EXCLUDE_FEATURES']),npoints)),torch.rand((2,11-len(config['SEGNET_EXCLUDE_FEATURES']),npoints))]
+    written = []
+    for variant in variants:
+        for net,name,example in zip([idnet,segnet],[config['IDNET_NAME'],config['SEGNET_NAME']],examples):
+            fname = linf.variantPath(name,variant)
+            torch.jit.save(buildVariant(net,variant,example),fname)
+            written.append(fname)
+            if verbose: print('Wrote {:s}'.format(fname))
+    return written
+
+#Compares the exported variants with the fp32 models on the lines of a held-out line_data file
+#For every variant reports the largest idnet score difference, the lines whose idnet decision at IDNET_THRESHOLD changes,
+#the segnet mask points and lines that change, and the time taken relative to fp32
+#returns a dict of these numbers keyed by variant
+def reportVariants(config,fname,variants=VARIANTS,verbose=True):
+    batchsize = config['INFERENCE_BATCH_SIZE']
+    idnthresh = config['IDNET_THRESHOLD']
+    core_lines,seg_lines,raw = lf.compileViews([fname],idnet_exclude=config['IDNET_EXCLUDE_FEATURES'],segnet_exclude=config['SEGNET_EXCLUDE_FEATURES'])
+    del raw
+
+    #runs both models of one variant, returning the scores, the masks and the time taken
+    def run(variant):
+        vconfig = dict(config)
+        vconfig['INFERENCE_VARIANT'] = variant
+        idnet,segnet = linf.loadModels(vconfig)
+        time1 = time.time()
+        scores = linf.idnetScores(idnet,core_lines,batchsize)
+        masks = linf.segnetMasks(segnet,seg_lines,batchsize)
+        return scores,masks,time.time()-time1
+
+    scores,masks,reftime = run('fp32')
+    report = {}
+    if verbose: print('{:d} held-out lines, fp32 takes {:.2f} s'.format(len(scores),reftime))
+    for variant in variants:
+        vscores,vmasks,vtime = run(variant)
+        report[variant] = {'max_score_error':float(np.max(np.abs(vscores-scores),initial=0)),
+                           'flipped_lines':int(np.sum((vscores>idnthresh) != (scores>idnthresh))),
+                           'mask_point_errors':float(np.mean(vmasks != masks)) if np.size(masks) > 0 else 0.,
+                           'mask_line_errors':int(np.sum(np.any(vmasks != masks,axis=1))),
+                           'speedup':reftime/max(vtime,1e-9)}
+        res = report[variant]
+        if verbose: print('{:s}: max score error {:.2e}, {:d} idnet decisions flipped, {:.3%} of mask points ({:d} lines) changed, {:.2f}x faster'.format(variant,res['max_score_error'],res['flipped_lines'],res['mask_point_errors'],res['mask_line_errors'],res['speedup']))
+    return report
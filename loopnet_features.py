@@ -0,0 +1,89 @@
+import numpy as np
+
+#Makes the phis (nlines x npoints, modulo 2pi from the integrator) continuous along each line and relative to the first point
+#Works in place, column by column over all lines at once, so every point receives the same sequence of 2pi shifts as in
+#the per-line rectifyPhis of loopnet_idnet and loopnet_segnet, and the results are identical
+def rectifyPhis(phis):
+    for j in range(1,np.shape(phis)[1]):
+        jump = np.abs(phis[:,j]-phis[:,j-1])>5
+        if not np.any(jump): continue
+        up = np.where(np.logical_and(jump,phis[:,j] > phis[:,j-1]))[0]
+        down = np.where(np.logical_and(jump,phis[:,j] <= phis[:,j-1]))[0]
+        phis[up,j:] += -2*np.pi
+        phis[down,j:] += 2*np.pi
+    phis -= phis[:,:1]
+    return phis
+
+#Signed cube root of the curvature along each line, also used by loopnet_idnet and loopnet_segnet. kept here so that
+#building the views does not need torch. assumes rs has shape nlines x 3 x nds+1
+def computeCurvature(rs):
+    dp = np.append(rs[:,0,1:] - rs[:,0,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
+    dt = np.append(rs[:,1,1:] - rs[:,1,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
+    dr = np.append(rs[:,2,1:] - rs[:,2,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
+    Tr = dr
+    Tt = dt*rs[:,2,:]
+    Tp = dp*rs[:,2,:]*np.sin(rs[:,1,:]) 
+    ds = np.sqrt(Tr**2+Tt**2+Tp**2)
+    ds[np.where(ds == 0)] = np.max(ds)
+    dTr = np.append(np.zeros((len(rs[:,0,0]),1)),Tr[:,1:]-Tr[:,:-1],axis=1)
+    dTt = np.append(np.zeros((len(rs[:,0,0]),1)),Tt[:,1:]-Tt[:,:-1],axis=1)
+    dTp = np.append(np.zeros((len(rs[:,0,0]),1)),Tp[:,1:]-Tp[:,:-1],axis=1)
+    curvature = np.sqrt(dTr**2+dTt**2+dTp**2)/ds**2
+    curvature[np.where(np.isnan(curvature))] = 0
+    curvature = np.cbrt(curvature) * np.sign(dTr)
+    return curvature
+
+#Difference between consecutive points along the last axis, with a zero first element
+def delta(x):
+    dx = np.zeros_like(x)
+    dx[...,1:] = x[...,1:]-x[...,:-1]
+    return dx
+
+#Rescales every channel of data (nlines x nchannels x npoints) in place to span 0 to 1 over all lines
+def normalizeChannels(data,verbose=False):
+    lo = np.min(data,axis=(0,2))
+    hi = np.max(data,axis=(0,2))
+    for k in range(np.shape(data)[1]):
+        if verbose: print('Variable {:d} has offset {:.2e} and range {:.2e}'.format(k,lo[k],hi[k]-lo[k]))
+    data -= lo[np.newaxis,:,np.newaxis]
+    data /= (hi-lo)[np.newaxis,:,np.newaxis]
+    return data
+
+#Loads the line_data files in file_list once and builds the three views used to find loops, identical to
+#  idnet: loopnet_idnet.compileData(file_list,exclude=idnet_exclude)
+#  segnet: loopnet_segnet.compileData(file_list,exclude=segnet_exclude)
+#  raw: loopnet_idnet.compileData(file_list,normalize=False)
+#The rectified phis and the curvature computed from them are shared by the idnet and segnet views. The raw view keeps the
+#unrectified phis, so its curvature has to be computed separately from those
+def compileViews(file_list,idnet_exclude=None,segnet_exclude=None,verbose=False):
+    files = [np.load(fname,mmap_mode='r') for fname in file_list]
+    shape = np.shape(files[0])
+    raw = np.empty((int(np.sum([len(f) for f in files])),shape[1]+1,shape[2]))
+    k = 0
+    for f in files:
+        raw[k:k+len(f),:-1,:] = f
+        k += len(f)
+    del files
+
+    idnet = raw.copy()
+    rectifyPhis(idnet[:,0,:])
+    curvature = computeCurvature(idnet[:,:3,:])
+    raw[:,-1,:] = computeCurvature(raw[:,:3,:])
+    raw[:,6,:] = np.abs(raw[:,6,:])
+
+    segnet = idnet.copy()
+    segnet[:,-1,:] = np.abs(curvature)
+    segnet[:,0,:] = delta(segnet[:,0,:])
+    segnet[:,1,:] = np.abs(np.pi-segnet[:,1,:])
+    segnet[:,3,:] = delta(segnet[:,3,:])
+    segnet[:,4,:] = delta(np.abs(segnet[:,4,:]))
+    segnet[:,6,:] = np.abs(segnet[:,6,:])
+    segnet[:,7,:] = np.sqrt(segnet[:,6,:]**2+segnet[:,7,:]**2)
+    normalizeChannels(segnet,verbose)
+    if not segnet_exclude is None: segnet = np.delete(segnet,segnet_exclude,axis=1)
+
+    idnet[:,-1,:] = curvature
+    idnet[:,6,:] = np.abs(idnet[:,6,:])
+    normalizeChannels(idnet,verbose)
+    if not idnet_exclude is None: idnet = np.delete(idnet,idnet_exclude,axis=1)
+    return idnet,segnet,raw
@@ -4,14 +4,20 @@ import matplotlib.pyplot as plt
 import numpy as np
 from cmd_util import *
 import sys
-from scipy.interpolate import RegularGridInterpolator as rgi
 from scipy.interpolate import interp1d
+from scipy.spatial import cKDTree
 from numpy.random import rand
 from diagnostic_reading import ReferenceState
-import loopnet_idnet as cnn
-import loopnet_segnet as wnet
-import torch
+import loopnet_rayleigh as lr
+import loopnet_integrate as li
+import loopnet_interp as lin
+import loopnet_inference as linf
+import loopnet_features as lf
+import loopnet_overlap as lo
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import loopnet_shared as lsh
+import loopnet_store as lst
 import time
 
 def deriv(x,f):
@@ -26,48 +32,16 @@ def deriv(x,f):
 
 #Calculates a streamline of length s initiated at X0 for the vector field represented by the interpolating functions
 def calcFieldLine(s,nds,X0,fnr,fnt,fnp,mult,phi,theta,r):
-    minr = np.min(r)
-    maxr = np.max(r)
-    mint = np.min(theta)
-    maxt = np.max(theta)
-    if X0[1]>maxt: 
-        X0[1]=2*maxt-X0[1]
-        X0[0]=X0[0]+np.pi
-    elif X0[1]<mint: 
-        X0[1]=-X0[1]
-        X0[0]=X0[0]+np.pi
-    if X0[0]>2*np.pi: X0[0]-=2*np.pi
-    elif X0[0]<0: X0[0]+=2*np.pi
-    if X0[2]>maxr: X0[2] = 2*maxr-X0[2]
-    elif X0[2]<minr: X0[2] = 2*minr-X0[2]
-
-    coords = np.zeros((3,nds+1))
-    coords[:,0]=X0
-    ds = s/nds*mult
-    for k in range(nds):
-        try:
-            br = fnr(coords[:,k])
-            bt = fnt(coords[:,k])
-            bp = fnp(coords[:,k])
-        except ValueError:
-            badc = coords[:,k]
-            for x in range(k,nds+1): coords[:,x]=coords[:,k-1]
-            return coords
-        B = np.sqrt(br**2+bt**2+bp**2)
-        coords[:,k+1]=coords[:,k]+ds/B*np.array([bp/np.abs(coords[2,k]*np.sin(coords[1,k])),bt/coords[2,k],br])[:,0]
-        if coords[1,k+1]>np.pi: 
-            coords[1,k+1]=2*np.pi-coords[1,k+1]
-            coords[0,k+1]=coords[0,k+1]+np.pi
-        elif coords[1,k+1]<0: 
-            coords[1,k+1]=-coords[1,k+1]
-            coords[0,k+1]=coords[0,k+1]+np.pi
-        if coords[0,k+1]>2*np.pi: coords[0,k+1]-=2*np.pi
-        elif coords[0,k+1]<0: coords[0,k+1]+=2*np.pi
-    try:
-        br = fnr(coords[:,-1])
-    except ValueError:
-        coords[:,-1]=coords[:,-2]
-    return coords
+    return li.calcFieldLines(s,nds,li.reflectSeeds(X0,theta,r),li.stackInterpolators(fnr,fnt,fnp),mult,phi,theta,r)[0]
+
+#Calculates a streamline through X0 running s/2 in nback steps behind it and s/2 in nfwd steps ahead of it, integrating both halves together
+def calcCenteredFieldLine(s,nback,nfwd,X0,fnr,fnt,fnp,phi,theta,r):
+    return calcCenteredFieldLines(s,nback,nfwd,X0,fnr,fnt,fnp,phi,theta,r)[0]
+
+#Same as calcCenteredFieldLine for an (M,3) array of seeds, returning an (M,3,nback+nfwd+1) array of lines
+def calcCenteredFieldLines(s,nback,nfwd,X0,fnr,fnt,fnp,phi,theta,r):
+    back,fwd = li.calcFieldLinesBidirectional(s/2,nback,s/2,nfwd,li.reflectSeeds(X0,theta,r),li.stackInterpolators(fnr,fnt,fnp),phi,theta,r)
+    return np.append(back[:,:,::-1],fwd[:,:,1:],axis=2)
 
 #Converts a 3xN array of phi,theta,r values to a 3xN array of x,y,z values 
 def sphToCart(a):
@@ -95,15 +69,11 @@ def checkOverlap(a,b,tolerance,threshold,verbose=False):
     if Nb*0.5 > Na: 
         if verbose: print('Size difference between lines too large. len b / a = ',Nb/Na)
         return False
-    for k in range(Nb+Na-2*Nmin):
-        al = np.max([0,Na-1-Nmin-k])
-        ar = np.min([Na-1,Na+Nb-2-Nmin-k])
-        bl = np.max([0,Nmin+k-Na+1])
-        br = np.min([Nb-1,Nmin+k])
-        N1 = len(np.where(np.sqrt(np.sum((a[:,al:ar+1]-b[:,bl:br+1])**2,axis=0))<=tolerance)[0])
-        if verbose: print('Match fraction is {:.2f}'.format(N1/Na))  
-        if N1 >= Nmin: return True
-    return False
+    counts = lo.shiftCounts(a,b,Nmin,tolerance)
+    match = np.where(counts >= Nmin)[0]
+    if verbose:
+        for N1 in counts[:(match[0]+1 if len(match) > 0 else len(counts))]: print('Match fraction is {:.2f}'.format(N1/Na))
+    return len(match) > 0
 
 def matchLength(a,b,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False): #Could be more efficient if I just pulled down the pre-segmentation lines instead of re-integrating
     Na = np.min([np.shape(a)[1],np.shape(b)[1]])
@@ -116,20 +86,11 @@ def matchLength(a,b,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False): #Could
     else: swapped = False
     Nb = len(b[0,:])
 
-    scores = np.zeros(Nb+Na-2*Nmin)
     axyz = sphToCart(a) #check the orientation of these vectors
     bxyz = sphToCart(b)
-    for k in range(Nb+Na-2*Nmin):
-        al = np.max([0,Na-1-Nmin-k])
-        ar = np.min([Na-1,Na+Nb-2-Nmin-k])
-        bl = np.max([0,Nmin+k-Na+1])
-        br = np.min([Nb-1,Nmin+k])
-        scores[k] = len(np.where(np.sqrt(np.sum((axyz[:,al:ar+1]-bxyz[:,bl:br+1])**2,axis=0))<=tolerance)[0])
+    scores = lo.shiftCounts(axyz,bxyz,Nmin,tolerance)
     kbest = np.argmax(scores)
-    albest = np.max([0,Na-1-Nmin-kbest])
-    arbest = np.min([Na-1,Na+Nb-2-Nmin-kbest])
-    blbest = np.max([0,Nmin+kbest-Na+1])
-    brbest = np.min([Nb-1,Nmin+kbest])
+    albest,arbest,blbest,brbest = lo.shiftBounds(kbest,Na,Nb,Nmin)
 
     if albest > 0 and arbest == Na-1: #Case left
         rightside = calcFieldLine(ds*(Nb-1-brbest),Nb-1-brbest,a[:,-1],fnr,fnt,fnp,1,phi,theta,r)
@@ -152,7 +113,19 @@ def matchLength(a,b,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False): #Could
     if swapped: return b,a
     else: return a,b
 
-def matchLengthGroup(struct,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False):
+#Extends the segment start:stop of a stored field line (3 x npoints) by leftadd points before it and rightadd points after it
+#Points are sliced from the stored line, and only the parts running past its ends are integrated
+def extendSegment(parent,start,stop,leftadd,rightadd,ds,phi,theta,r,fnp,fnt,fnr):
+    L = np.shape(parent)[1]
+    lo = start-leftadd
+    hi = stop+rightadd
+    line = parent[:3,max(0,lo):min(L,hi)]
+    if lo < 0: line = np.append(calcFieldLine(ds*(-lo),-lo,line[:,0],fnr,fnt,fnp,-1,phi,theta,r)[:,::-1],line[:,1:],axis=1)
+    if hi > L: line = np.append(line,calcFieldLine(ds*(hi-L),hi-L,line[:,-1],fnr,fnt,fnp,1,phi,theta,r)[:,1:],axis=1)
+    return line
+
+#parents and sources, when given, locate each loop in struct as parents[sources[j][0]][:,sources[j][1]:sources[j][2]]
+def matchLengthGroup(struct,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False,parents=None,sources=None):
     lengths = [np.shape(st)[1] for st in struct]
     longest_ind = np.argmax(lengths)
     longest_xyz = sphToCart(struct[longest_ind])
@@ -167,20 +140,11 @@ def matchLengthGroup(struct,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False):
     for j in range(len(struct)):
         if not j == longest_ind:
             Na = lengths[j]
-            scores = np.zeros(Nb+Na-2*Nmin)
             axyz = sphToCart(struct[j])
-            for k in range(Nb+Na-2*Nmin):
-                al = np.max([0,Na-1-Nmin-k])
-                ar = np.min([Na-1,Na+Nb-2-Nmin-k])
-                bl = np.max([0,Nmin+k-Na+1])
-                br = np.min([Nb-1,Nmin+k])
-                scores[k] = len(np.where(np.sqrt(np.sum((axyz[:,al:ar+1]-longest_xyz[:,bl:br+1])**2,axis=0))<=tolerance)[0])
+            scores = lo.shiftCounts(axyz,longest_xyz,Nmin,tolerance)
             kbest = np.argmax(scores)
             kbests[j] = kbest
-            albest = np.max([0,Na-1-Nmin-kbest])
-            arbest = np.min([Na-1,Na+Nb-2-Nmin-kbest])
-            blbest = np.max([0,Nmin+kbest-Na+1])
-            brbest = np.min([Nb-1,Nmin+kbest])
+            albest,arbest,blbest,brbest = lo.shiftBounds(kbest,Na,Nb,Nmin)
             if albest > 0 and arbest == Na-1: #Case left
                 rightadds[j,longest_ind] = Nb-1-brbest
                 leftadds[longest_ind,j] = albest
@@ -204,14 +168,16 @@ def matchLengthGroup(struct,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False):
                     if lengths[j]+rightadds[j,k] <= lengths[k]: leftadds[j,k] = lengths[k] - (lengths[j]+rightadds[j,k])
                     else: leftadds[k,j] = lengths[j]+rightadds[j,k] - lengths[k]
 
-    #integrate things out so that all loops have the same length
+    #integrate things out so that all loops have the same length, or slice them out of their stored parent lines when available
     newstruct = []
     for j in range(len(struct)):
         thisline = struct[j][:3,:]
         leftadd = int(np.max(leftadds[j,:]))
         rightadd = int(np.max(rightadds[j,:]))
-        if leftadd > 0: thisline = np.append(calcFieldLine(ds*leftadd,leftadd,thisline[:,0],fnr,fnt,fnp,-1,phi,theta,r)[:,::-1],thisline[:,1:],axis=1)
-        if rightadd > 0: thisline = np.append(thisline,calcFieldLine(ds*rightadd,rightadd,thisline[:,-1],fnr,fnt,fnp,1,phi,theta,r)[:,1:],axis=1)
+        if not sources is None: thisline = extendSegment(parents[sources[j][0]],sources[j][1],sources[j][2],leftadd,rightadd,ds,phi,theta,r,fnp,fnt,fnr)
+        else:
+            if leftadd > 0: thisline = np.append(calcFieldLine(ds*leftadd,leftadd,thisline[:,0],fnr,fnt,fnp,-1,phi,theta,r)[:,::-1],thisline[:,1:],axis=1)
+            if rightadd > 0: thisline = np.append(thisline,calcFieldLine(ds*rightadd,rightadd,thisline[:,-1],fnr,fnt,fnp,1,phi,theta,r)[:,1:],axis=1)
         newstruct.append(thisline)
           
     return newstruct
@@ -220,13 +186,14 @@ def matchLengthGroup(struct,tolerance,ds,phi,theta,r,fnp,fnt,fnr,verbose=False):
 
 
 
-def reduceStructure(struct,nlines,rlrstar,rltol,threshold,ds,phi,theta,r,fnp,fnt,fnr,verbose=False):
+#parents and sources are passed on to matchLengthGroup to extend the loops from the lines they were segmented from
+def reduceStructure(struct,nlines,rlrstar,rltol,threshold,ds,phi,theta,r,fnp,fnt,fnr,verbose=False,batchsize=16,parents=None,sources=None,rng=None):
     #If there are multiple field lines in the structure, make sure they all have the same length
 
     N = np.max([np.shape(st)[1] for st in struct]) 
 
     if verbose: print('Matching up loop lengths...')
-    struct = matchLengthGroup(struct,rlrstar*rltol,ds,phi,theta,r,fnp,fnt,fnr,verbose)
+    struct = matchLengthGroup(struct,rlrstar*rltol,ds,phi,theta,r,fnp,fnt,fnr,verbose,parents,sources)
     if verbose: print('Done fixing lengths')
     cline_xyz_or = np.zeros((3,1))
     for st in struct: cline_xyz_or += sphToCart(st[:3,[N//2]])/len(struct)
@@ -237,40 +204,59 @@ def reduceStructure(struct,nlines,rlrstar,rltol,threshold,ds,phi,theta,r,fnp,fnt
     dr = rlrstar
     this_nds = N-1
     this_s = ds*this_nds
-    centerline = np.append(calcFieldLine(this_s/2,N//2,line_origin,fnr,fnt,fnp,-1,phi,theta,r)[:,::-1],calcFieldLine(this_s/2,N-N//2-1,line_origin,fnr,fnt,fnp,1,phi,theta,r)[:,1:],axis=1)
+    centerline = calcCenteredFieldLine(this_s,N//2,N-N//2-1,line_origin,fnr,fnt,fnp,phi,theta,r)
     cline_xyz = sphToCart(centerline)
 
-    #Generate a bunch of field lines around the central line
-    distances = np.zeros((1,N))
-    kept_lines = centerline.reshape(1,3,-1)
+    #Generate a bunch of field lines around the central line, integrating a batch of candidate seeds at a time
+    #Seeds are drawn as offsets within the unit window and tried in the order they were drawn. Once a seed resizes the
+    #window, the offsets after it are integrated again in the next batch with the new window, so every line is kept or
+    #rejected exactly as if the seeds had been integrated one at a time
+    #distances keeps a row for every line accepted, including any accepted before a mulligan
+    #the offsets come from rng if one is given, otherwise from the global numpy random state
+    distances = np.zeros((2*nlines-1,N))
+    ndist = 1
+    kept_lines = np.zeros((nlines,3,N))
+    kept_lines[0] = centerline
+    nkept = 1
+    offsets = np.zeros((0,3))
     misses = 0 #track how many lines we have to draw before it works out
     shrinks = 0
     already_mulliganed = False
     if verbose: print('Integrating volume lines...')
-    while np.shape(kept_lines)[0] < nlines:   #xxx check where it is at the end, not where else it goes
-        x = (2*rand(3)-1)*np.array([dphi,dtheta,dr])+np.array(line_origin)
-        rs = np.append(calcFieldLine(this_s/2,N//2,x,fnr,fnt,fnp,-1,phi,theta,r)[:,::-1],calcFieldLine(this_s/2,N-N//2-1,x,fnr,fnt,fnp,1,phi,theta,r)[:,1:],axis=1)
-        xs = sphToCart(rs)
-        dist = np.sqrt(np.sum((xs-cline_xyz)**2,axis=0))
-        
-        if np.max(dist) <= rlrstar*rltol*1.5:
-            distances = np.append(distances,np.sqrt(np.sum((xs-cline_xyz)**2,axis=0)).reshape(1,-1),axis=0)
-            kept_lines = np.append(kept_lines,rs.reshape(1,3,-1),axis=0)
-            if misses == 0: #if we hit it on the first try, let's expand the starting radius
-                dr *= 1.25
-                dtheta *= 1.25
-                dphi *= 1.25
-                shrinks += -1 
-            misses = 0
-        elif misses > 15: #if it's taking too long to get a hit, let's constrict the starting radius
-            dr /= 1.25
-            dtheta /= 1.25
-            dphi /= 1.25
-            if verbose: print('Lines too divergent, shrunk the seeding window')
-            shrinks += 1
-            misses = 0
-        else: misses += 1
-        if shrinks >= 5*np.shape(kept_lines)[0]: #if I have to shrink too much, something is wrong.
+    while nkept < nlines:   #xxx check where it is at the end, not where else it goes
+        if len(offsets) < batchsize: offsets = np.append(offsets,2*(rand(batchsize-len(offsets),3) if rng is None else rng.random((batchsize-len(offsets),3)))-1,axis=0)
+        x = offsets*np.array([dphi,dtheta,dr])+np.array(line_origin)
+        rs = calcCenteredFieldLines(this_s,N//2,N-N//2-1,x,fnr,fnt,fnp,phi,theta,r)
+        xs = sphToCart(np.transpose(rs,(1,0,2)).reshape(3,-1)).reshape(3,batchsize,N).transpose(1,0,2)
+        dist = np.sqrt(np.sum((xs-cline_xyz)**2,axis=1))
+        hit = np.max(dist,axis=1) <= rlrstar*rltol*1.5
+        for k in range(batchsize):
+            resized = False
+            if hit[k]:
+                distances[ndist] = dist[k]
+                kept_lines[nkept] = rs[k]
+                ndist += 1
+                nkept += 1
+                if misses == 0: #if we hit it on the first try, let's expand the starting radius
+                    dr *= 1.25
+                    dtheta *= 1.25
+                    dphi *= 1.25
+                    shrinks += -1 
+                    resized = True
+                misses = 0
+            elif misses > 15: #if it's taking too long to get a hit, let's constrict the starting radius
+                dr /= 1.25
+                dtheta /= 1.25
+                dphi /= 1.25
+                if verbose: print('Lines too divergent, shrunk the seeding window')
+                shrinks += 1
+                misses = 0
+                resized = True
+            else: misses += 1
+            if resized or shrinks >= 5*nkept or nkept == nlines: break
+        offsets = offsets[k+1:]
+        xs = xs[k]
+        if shrinks >= 5*nkept: #if I have to shrink too much, something is wrong.
             if not already_mulliganed:
                 mididx = np.argmin([np.mean(np.sum((cline_xyz-sphToCart(st[:3,:])**2),axis=1)) for st in struct])
                 if verbose: print('Shrunk too many times, using line {:d} as the centerline'.format(mididx))
@@ -280,7 +266,8 @@ def reduceStructure(struct,nlines,rlrstar,rltol,threshold,ds,phi,theta,r,fnp,fnt
                 dphi = rlrstar/np.sin(line_origin[1])/line_origin[2]
                 dtheta = rlrstar/line_origin[2]
                 dr = rlrstar
-                kept_lines = centerline.reshape(1,3,-1)
+                kept_lines[0] = centerline
+                nkept = 1
                 shrinks = 0
                 already_mulliganed = True
             else:
@@ -306,75 +293,174 @@ def reduceStructure(struct,nlines,rlrstar,rltol,threshold,ds,phi,theta,r,fnp,fnt
             
 
     #Use the distances from the generated lines to the central one to calculate a 2sig radius
-    line_radius = 2*np.std(distances,axis=0) #xxx project into the nearest tangent plane and consider options other than std
+    line_radius = 2*np.std(distances[:ndist],axis=0) #xxx project into the nearest tangent plane and consider options other than std
 
     #Return the central line and its radius function
     return centerline, line_radius
 
 
-#mask is the argmax of the output of wnet(line)
+#Run-length encoding of a batch of segnet masks (nlines x npoints)
+#returns the first point of every run, padded with npoints (nlines x maxruns+1), the class of every run (nlines x maxruns)
+#and the number of runs in each line
+def runLengths(masks):
+    nlines,npoints = np.shape(masks)
+    change = masks[:,1:] != masks[:,:-1]
+    nruns = 1+np.sum(change,axis=1)
+    starts = np.full((nlines,int(np.max(nruns,initial=1))+1),npoints)
+    starts[:,0] = 0
+    rows,cols = np.nonzero(change)
+    starts[rows,np.cumsum(change,axis=1)[rows,cols]] = cols+1
+    classes = np.take_along_axis(masks,np.minimum(starts[:,:-1],npoints-1),axis=1)
+    return starts,classes,nruns
+
+#Folds runs shorter than minlen into their neighbours, working along every line from the start as detectLoops always has:
+#a short first run joins the next one, a short run between two runs of the same class merges all three into one,
+#and any other short run is split between its neighbours at its midpoint. The last run of a line is never folded
+#The lines are stepped through together, with runs that have been folded away marked dead rather than removed
+#starts is changed in place, and the returned array marks the runs that are left
+def mergeRuns(starts,classes,nruns,minlen):
+    alive = np.arange(np.shape(classes)[1])[np.newaxis,:] < nruns[:,np.newaxis]
+    k = np.zeros(len(nruns),dtype=int) #the run being checked, every run after it is untouched so far
+    prev = np.full(len(nruns),-1) #the last run left before it
+    while True:
+        act = np.where(k < nruns-1)[0]
+        if len(act) == 0: break
+        ka = k[act]
+        short = starts[act,ka+1]-starts[act,ka] < minlen
+        first = np.logical_and(short,prev[act] < 0)
+        sandwich = np.logical_and(np.logical_and(short,prev[act] >= 0),classes[act,np.maximum(prev[act],0)] == classes[act,ka+1])
+        divide = np.logical_and(short,np.logical_not(np.logical_or(first,sandwich)))
+
+        rows = act[np.logical_not(short)]
+        prev[rows] = k[rows]
+        k[rows] += 1
+        rows = act[first]
+        starts[rows,k[rows]+1] = starts[rows,k[rows]]
+        alive[rows,k[rows]] = False
+        k[rows] += 1
+        rows = act[sandwich]
+        alive[rows,k[rows]] = False
+        alive[rows,k[rows]+1] = False
+        k[rows] += 2
+        rows = act[divide]
+        starts[rows,k[rows]+1] = (starts[rows,k[rows]]+starts[rows,k[rows]+1])//2
+        alive[rows,k[rows]] = False
+        k[rows] += 1
+    return alive
+
+#Aho-Corasick automaton matching every pattern (a non-empty sequence of class numbers) at once
+#returns the transition table (nstates x nclass) and which patterns end in each state (nstates x npatterns)
+def buildMatcher(patterns,nclass):
+    goto = [{}]
+    ends = [[]]
+    for p in range(len(patterns)):
+        if len(patterns[p]) == 0: continue
+        node = 0
+        for c in patterns[p]:
+            if not c in goto[node]:
+                goto[node][c] = len(goto)
+                goto.append({})
+                ends.append([])
+            node = goto[node][c]
+        ends[node].append(p)
+    delta = np.zeros((len(goto),nclass),dtype=int)
+    out = np.zeros((len(goto),len(patterns)),dtype=bool)
+    fail = np.zeros(len(goto),dtype=int)
+    queue = [0]
+    for node in queue:
+        out[node,ends[node]] = True
+        if node > 0: out[node] |= out[fail[node]]
+        for c in range(nclass):
+            if c in goto[node]:
+                child = goto[node][c]
+                fail[child] = delta[fail[node],c] if node > 0 else 0
+                delta[node,c] = child
+                queue.append(child)
+            else: delta[node,c] = delta[fail[node],c] if node > 0 else 0
+    return delta,out
+
+#Finds the loops in a batch of segnet masks (nlines x npoints) by matching class sequences to the runs of each line
+#masks are the argmax of the output of wnet(lines)
 #seqs is a list of mask value sequences to interpret as representing a loop, e.g. [[1,2,1],[3]]
 #cseqs is a list of mask value sequences where only the central value is part of the loop, e.g. [[0,1,0],[0,3,0]]
 #buff is the number of indices to rope in on each side of an identified loop
 #segmin is the minimum length of a segment as a fraction of the whole line
 #segmax is the maximum length of a loop as a fraction of the whole line
-#loops is a list of lists of indices corresponding to loop segments in the input line mask
-def detectLoops(mask, seqs = [], cseqs = [], buff = 0, segmin = 0, segmax = 1):
-    keys = [0]
-    blocked = [mask[0]]
-    for k in range(1,len(mask)):
-        if not mask[k] == blocked[-1]: 
-            keys.append(k)
-            blocked.append(mask[k])
-    keys.append(len(mask))
-    
-    if segmin>0:
-        k = 0
-        while k < len(keys)-2:
-            if (keys[k+1]-keys[k]) < segmin*len(mask):
-                if k == 0: #If this is the first segment, just fold it into the one after
-                    keys.pop(k+1)
-                    blocked = blocked[1:]
-                elif k+2 == len(keys): #If this is the last segment, just fold it into the one before
-                    keys.pop(k)
-                    blocked = blocked[:-1]
-                elif blocked[k-1] == blocked[k+1]: #If the short segment is sandwiched by two segments of the same type, just merge them
-                    keys.pop(k) 
-                    keys.pop(k)
-                    blocked.pop(k)
-                    blocked.pop(k)
-                else: #Not an edge, and the flanking segments are different, so divide this one up between them
-                    mididx = int(np.floor((keys[k]+keys[k+1])/2))
-                    keys.pop(k)
-                    keys[k] = mididx
-                    blocked.pop(k)
-            else: k+=1 
-
-    loops = []
-    for s in seqs:
-        for k in range(len(blocked)+1-len(s)):
-            if blocked[k:k+len(s)] == s and np.min([keys[k+len(s)]+buff,len(mask)])-np.max([keys[k]-buff,0]) <= segmax*len(mask): 
-                loops.append(np.arange(np.max([keys[k]-buff,0]),np.min([keys[k+len(s)]+buff,len(mask)])))
-    for s in cseqs:
-        for k in range(len(blocked)+1-len(s)):
-            if blocked[k:k+len(s)] == s and np.min([keys[k+len(s)-1]+buff,len(mask)])-np.max([keys[k+1]-buff,0]) <= segmax*len(mask): 
-                loops.append(np.arange(np.max([keys[k+1]-buff,0]),np.min([keys[k+len(s)-1]+buff,len(mask)])))
+#Runs shorter than segmin (as a fraction of npoints) are folded into their neighbours first (see mergeRuns)
+#A match of a sequence in seqs gives the points of its runs, and a match of one in cseqs the points of its runs without the
+#first and last; either way buff points are added on both ends, and loops longer than segmax (as a fraction of npoints) are dropped
+#returns, for every line, a list of arrays of point indices, ordered by sequence (seqs first), then by position along the line
+def detectLoopsBatch(masks, seqs = [], cseqs = [], buff = 0, segmin = 0, segmax = 1):
+    masks = np.asarray(masks)
+    nlines,npoints = np.shape(masks)
+    if nlines == 0: return []
+    starts,classes,nruns = runLengths(masks)
+    if segmin>0: alive = mergeRuns(starts,classes,nruns,segmin*npoints)
+    else: alive = np.arange(np.shape(classes)[1])[np.newaxis,:] < nruns[:,np.newaxis]
+
+    #packs the runs that are left to the front of each row, with keys holding their first points and then npoints
+    nalive = np.sum(alive,axis=1)
+    order = np.argsort(np.logical_not(alive),axis=1,kind='stable')
+    valid = np.arange(np.shape(classes)[1])[np.newaxis,:] < nalive[:,np.newaxis]
+    keys = np.full(np.shape(starts),npoints)
+    keys[:,:-1] = np.where(valid,np.take_along_axis(starts[:,:-1],order,axis=1),npoints)
+    keys[np.arange(nlines),nalive] = npoints
+    blocked = np.where(valid,np.take_along_axis(classes,order,axis=1),0)
+
+    patterns = list(seqs)+list(cseqs)
+    plen = np.array([len(pat) for pat in patterns],dtype=int)
+    nclass = int(max([np.max(masks)]+[np.max(pat) for pat in patterns if len(pat) > 0]))+1
+    delta,out = buildMatcher(patterns,nclass)
+    state = np.zeros(nlines,dtype=int)
+    hits = [np.zeros((3,0),dtype=int)]
+    for j in range(int(np.max(nalive))):
+        state = np.where(valid[:,j],delta[state,blocked[:,j]],0)
+        rows,pats = np.nonzero(np.logical_and(out[state],valid[:,j,np.newaxis]))
+        hits.append(np.array([rows,pats,j+1-plen[pats]]))
+    rows,pats,k = np.concatenate(hits,axis=1)
+    idx = np.lexsort((k,pats,rows))
+    rows,pats,k = rows[idx],pats[idx],k[idx]
+
+    crop = (pats >= len(seqs)).astype(int)
+    lo = np.maximum(keys[rows,k+crop]-buff,0)
+    hi = np.minimum(keys[rows,k+plen[pats]-crop]+buff,npoints)
+    keep = hi-lo <= segmax*npoints
+    loops = [[] for j in range(nlines)]
+    for j,l,h in zip(rows[keep],lo[keep],hi[keep]): loops[j].append(np.arange(l,h))
     return loops
 
+#Finds the loops in a single segnet mask, see detectLoopsBatch
+def detectLoops(mask, seqs = [], cseqs = [], buff = 0, segmin = 0, segmax = 1):
+    return detectLoopsBatch(np.asarray(mask)[np.newaxis,:],seqs=seqs,cseqs=cseqs,buff=buff,segmin=segmin,segmax=segmax)[0]
+
 #loops should be a list of line objects that have been generated from the indices returned by detectLoops
+#Groups loops into structures: each loop joins the earliest structure holding a loop it overlaps (checkOverlap), else starts a new one
+#Cartesian coordinates are computed once per loop, and a KD-tree over all loop points limits checkOverlap to pairs that can pass it:
+#unless the overlap threshold rounds down to zero points, a match needs at least one pair of points within rad
 def detectStructures(loops,rad,thresh,passes=1):
     if len(loops) == 0: return []
+    xyz = [sphToCart(l[:,:3].T) for l in loops]
+    lengths = np.array([np.shape(x)[1] for x in xyz])
+    owner = np.repeat(np.arange(len(loops)),lengths)
+    tree = cKDTree(np.concatenate(xyz,axis=1).T)
+    label = np.zeros(len(loops),dtype=int)
     structures = [[0]]
     for j in range(1,len(loops)): #See if it matches anything in the current structure file
+        near = tree.query_ball_point(xyz[j].T,rad*(1+1e-9))
+        near = owner[np.concatenate([np.array(n,dtype=int) for n in near])]
+        wild = np.where(np.floor(np.minimum(lengths[:j],lengths[j])*thresh) == 0)[0]
+        cands = np.unique(np.append(near[near < j],wild))
+        #the candidates are checked in the order the loops were originally compared: by structure, then by position in it
+        cands = cands[np.lexsort((cands,label[cands]))]
         matched = False
-        thisxyz = sphToCart(loops[j][:,:3].T)
-        for k in range(len(structures)):
-            for kk in range(len(structures[k])):
-                vb = False
-                if matched == False and checkOverlap(thisxyz,sphToCart(loops[structures[k][kk]][:,:3].T),rad,thresh,verbose=vb):
-                    structures[k].append(j)
-                    matched = True
+        for m in cands:
+            if checkOverlap(xyz[j],xyz[m],rad,thresh):
+                label[j] = label[m]
+                structures[label[j]].append(j)
+                matched = True
+                break
         if not matched: 
+            label[j] = len(structures)
             structures.append([j]) #If no matches were found, just drop it at the end
     return structures
 
@@ -414,15 +500,38 @@ def cylinderMesh(linexs,rline,verbose=False):
         cylmesh[2,:,k] = (Nz[k]*stheta+Wz[k]*ctheta)*rline[k]+linexs[2,k]
     return cylmesh
 
+#State of a worker reducing structures, set up once by initStructureWorker
+_reduce = {}
+
+#Prepares a worker to reduce structures, from a shared memory spec or (in the serial case) the fields themselves
+def initStructureWorker(fields,params):
+    global _reduce
+    if isinstance(fields,tuple):
+        fields,shm = lsh.attachShared(fields)
+        _reduce = {'shm':shm}
+    else: _reduce = {}
+    _reduce.update(params)
+    fn = lin.TrilinearInterpolator((params['phi'],params['theta'],params['r']),fields)
+    _reduce['fns'] = [fn.component(k) for k in range(3)]
+
+#Reduces structure ss to its centerline and radius with reduceStructure
+#The volume line seeds come from a random stream that depends only on the seed and ss, so the results do not depend on the
+#number of workers or on the order in which the structures are reduced
+def reduceShard(ss):
+    p = _reduce
+    fnr,fnt,fnp = p['fns']
+    rng = np.random.default_rng(np.random.SeedSequence(p['seed']+[ss]))
+    struct = [p['loops'][j].T for j in p['structures'][ss]]
+    sources = [p['sources'][j] for j in p['structures'][ss]]
+    return reduceStructure(struct,p['nlines'],p['rlrstar'],p['rltol'],p['threshold'],p['ds'],p['phi'],p['theta'],p['r'],fnp,fnt,fnr,p['verbose'],p['vbatch'],p['parents'],sources,rng)
+
 def worker(fname,config):
     start_time = time.time()
     fname_pref = config['LOOP_STRUCTURES_PREFIX']
     dataname = config['FIELD_LINES_PREFIX']
-    netname = config['IDNET_NAME']
     idnthresh = config['IDNET_THRESHOLD']
-    wnetname = config['SEGNET_NAME']
-    nclass = config['SEGNET_NUM_CLASS']
     exclude = config['SEGNET_EXCLUDE_FEATURES']
+    idexclude = config['IDNET_EXCLUDE_FEATURES']
     seqs = config['SEGNET_LOOP_SEQUENCES']
     cseqs = config['SEGNET_LOOP_CSEQUENCES']
     lbuffer = config['SEGMENTATION_BUFFER_PIXELS']
@@ -441,6 +550,9 @@ def worker(fname,config):
     segmax = config['LOOP_STRUCTURES_MAXIMUM_SEGMENT']
     s = config['FIELD_LINE_LENGTH']
     nds = config['FIELD_LINE_INTEGRATION_STEPS']
+    vbatch = config['LOOP_STRUCTURES_VOLUME_BATCH_SIZE']
+    nworkers = config['MULTITHREADING_WORKERS_PER_FILE']
+    rseed = config['LOOP_STRUCTURES_RANDOM_SEED']
 
     verbose = config['VERBOSE']
     plotty = config['WRITE_IMAGES']
@@ -452,43 +564,15 @@ def worker(fname,config):
     
     print('Working on file {:s}...'.format(fname))
     time1 = time.time()
-    f = open('{:s}{:s}_grid'.format(dir3d,fname),'rb')
-    skipbyte = np.fromfile(f,count=1,dtype=np.int32)
-    nr = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nt = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nphi = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    r = np.fromfile(f,count=nr,dtype=np.float64)[::-1]
-    try: 
-        overlap_ind = np.where(r[1:]==r[:-1])[0][0]
-        r = np.append(r[:overlap_ind],r[overlap_ind+1:])
-    except IndexError: overlap_ind = None
-    skipbyte = np.fromfile(f,count=1,dtype=np.float64)
-    theta = np.fromfile(f,count=nt,dtype=np.float64)[::-1]
-    phi = np.linspace(0,2*np.pi,nphi+1)
-    f.close()
-    nB = nr*nt*nphi
-
-    f = open('{:s}{:s}_0801'.format(dir3d,fname),'rb')
-    Br = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Br = np.append(Br[:,:,:overlap_ind],Br[:,:,overlap_ind+1:],axis=2)
-    Br = np.append(Br,np.expand_dims(Br[0,:,:],axis=0),axis=0)
-    f.close()
-    f = open('{:s}{:s}_0802'.format(dir3d,fname),'rb')
-    Bt = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Bt = np.append(Bt[:,:,:overlap_ind],Bt[:,:,overlap_ind+1:],axis=2)
-    Bt = np.append(Bt,np.expand_dims(Bt[0,:,:],axis=0),axis=0)
-    f.close()
-    f = open('{:s}{:s}_0803'.format(dir3d,fname),'rb')
-    Bp = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Bp = np.append(Bp[:,:,:overlap_ind],Bp[:,:,overlap_ind+1:],axis=2)
-    Bp = np.append(Bp,np.expand_dims(Bp[0,:,:],axis=0),axis=0)
-    f.close()
-    fnr = rgi((phi,theta,r),Br)
-    fnt = rgi((phi,theta,r),Bt)
-    fnp = rgi((phi,theta,r),Bp)
+    grid = lr.readGrid(dir3d,fname)
+    r = grid['r']
+    theta = grid['theta']
+    phi = grid['phi']
+    #the fields go straight into shared memory when the structures are shared out between several workers
+    shape = lr.fieldsShape(grid,3)
+    if nworkers > 1: fields,shm,spec = lsh.createShared(shape)
+    else: fields = np.empty(shape)
+    lr.readFields(dir3d,fname,['0801','0802','0803'],grid,out=fields)
 
     #Building the color maps
     fncr = None
@@ -500,17 +584,10 @@ def worker(fname,config):
 
     if verbose: print('Preparing line data')
     time1 = time.time()
-    core_lines = cnn.compileData(['{:s}{:s}_f{:s}.npy'.format(dirlines,dataname,fname)])
-    seg_lines = wnet.compileData(['{:s}{:s}_f{:s}.npy'.format(dirlines,dataname,fname)],exclude=exclude)
-    unnormed_core_lines = cnn.compileData(['{:s}{:s}_f{:s}.npy'.format(dirlines,dataname,fname)],normalize=False)
+    core_lines,seg_lines,unnormed_core_lines = lf.compileViews(['{:s}{:s}_f{:s}.npy'.format(dirlines,dataname,fname)],idnet_exclude=idexclude,segnet_exclude=exclude,verbose=verbose)
 
     if verbose: print('Applying the identification network...')
-    idnet = cnn.Net()
-    idnet.load_state_dict(torch.load(netname))
-    scores = np.zeros(np.shape(core_lines)[0])
-    for k in range(np.shape(core_lines)[0]):
-        output = idnet(torch.from_numpy(np.expand_dims(core_lines[k,:,:],axis=0)).float()).detach().numpy()[0]
-        scores[k] = output[1]
+    scores = linf.scoreLines(config,core_lines)
     ididx = np.where(scores>idnthresh)[0]
     if verbose: print('Kept {:d} out of {:d} lines'.format(len(ididx),np.shape(core_lines)[0]))
     core_lines = core_lines[ididx,:,:]
@@ -518,15 +595,14 @@ def worker(fname,config):
     loopy_unnormed_core_lines = unnormed_core_lines[ididx,:,:]
 
     if verbose: print('Applying the segmentation network...')
-    segnet = wnet.WNet(K=nclass,nvar=11-len(exclude))
-    segnet.load_state_dict(torch.load(wnetname))
+    masks = linf.segmentLines(config,seg_lines)
     loops = []
+    sources = [] #the loopy line each loop was cut from, and where
+    loop_idx = detectLoopsBatch(masks,seqs=seqs,cseqs=cseqs,buff=lbuffer,segmin=segmin,segmax=segmax)
     for j in range(np.shape(seg_lines)[0]):
-        img = torch.from_numpy(np.expand_dims(seg_lines[j,:,:],axis=0)).float()
-        mask = np.argmax(segnet(img,ret='enc').detach().float(),axis=1)[0,:]
-        loop_idx = detectLoops(mask,seqs=seqs,cseqs=cseqs,buff=lbuffer,segmin=segmin,segmax=segmax)
-        for l in loop_idx:
+        for l in loop_idx[j]:
             loops.append(loopy_unnormed_core_lines[j,:,l])
+            sources.append((j,l[0],l[-1]+1))
     if verbose: print('Found {:d} loop candidates in {:d} loopy lines...'.format(len(loops),np.shape(core_lines)[0]))
     if verbose: print('Searching for matching structures...')
     structures = detectStructures(loops,rstar*rltol*rlines,threshold)
@@ -534,11 +610,20 @@ def worker(fname,config):
     if verbose: print('Merging structures...')
     print(structures)
     print(loops)
-    merged_structures = [] 
-    for ss in range(len(structures)):
-        struct = [loops[j].T for j in structures[ss]]
-        cline,rline = reduceStructure(struct,nlines,rlines*rstar,rltol,threshold,s/nds,phi,theta,r,fnp,fnt,fnr,verbose)
-        merged_structures.append((cline,rline))
+    if rseed is None: rseed = int(time.time())
+    params = {'phi':phi,'theta':theta,'r':r,'loops':loops,'structures':structures,'sources':sources,'parents':loopy_unnormed_core_lines,
+              'nlines':nlines,'rlrstar':rlines*rstar,'rltol':rltol,'threshold':threshold,'ds':s/nds,'verbose':verbose,'vbatch':vbatch,'seed':[rseed,int(fname)]}
+    #a process pool (rather than mp.Pool) hands a structure that gives up with sys.exit back to this worker as an exception
+    if nworkers > 1:
+        try:
+            with ProcessPoolExecutor(max(1,min(nworkers,len(structures))),initializer=initStructureWorker,initargs=(spec,params)) as pool: merged_structures = list(pool.map(reduceShard,range(len(structures))))
+        finally:
+            del fields
+            lsh.releaseShared(shm,unlink=True)
+    else:
+        initStructureWorker(fields,params)
+        merged_structures = [reduceShard(ss) for ss in range(len(structures))]
+    _reduce.clear()
     if verbose: print('Spent {:.2f} minutes preparing loop data'.format((time.time()-time1)/60))
 
     if plotty:
@@ -577,7 +662,7 @@ def worker(fname,config):
             plt.close('all')
             if verbose: print('Saved file {:s}{:s}_f{:s}_s{:03d}.png'.format(dirfig,fname_pref,fname,ss))
         if verbose: print('Spent {:.2f} minutes plotting'.format((time.time()-time1)/60))
-    np.save('{:s}{:s}_f{:s}'.format(dirstruct,fname_pref,fname),merged_structures)
+    lst.saveStructures(dirstruct,fname_pref,fname,merged_structures,config)
     print('Finished work on file {:s} after {:.2f} minutes'.format(fname,(time.time()-start_time)/60))
         
 
@@ -1,45 +1,19 @@
 import numpy as np
 from cmd_util import *
 import sys
-from scipy.interpolate import RegularGridInterpolator as rgi
 from scipy.interpolate import interp1d
-from numpy.random import rand,seed
+from scipy.sparse import csr_matrix
+from numpy.random import randint,seed
 from diagnostic_reading import ReferenceState
 import multiprocessing as mp
 import time
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-
-#Calculates a streamline of length s initiated at X0 for the vector field represented by the interpolating functions
-def calcFieldLine(s,nds,X0,fnr,fnt,fnp,mult):
-    coords = np.zeros((3,nds+1))
-    coords[:,0]=X0
-    ds = s/nds*mult
-    for k in range(nds):
-        try:
-            br = fnr(coords[:,k])
-            bt = fnt(coords[:,k])
-            bp = fnp(coords[:,k])
-        except ValueError:
-            badc = coords[:,k]
-            for x in range(k,nds+1): coords[:,x]=coords[:,k-1]
-            return coords
-        B = np.sqrt(br**2+bt**2+bp**2)
-        coords[:,k+1]=coords[:,k]+ds/B*np.array([bp/np.abs(coords[2,k]*np.sin(coords[1,k])),bt/coords[2,k],br])[:,0]
-        if coords[1,k+1]>np.pi: 
-            coords[1,k+1]=2*np.pi-coords[1,k+1]
-            coords[0,k+1]=coords[0,k+1]+np.pi
-        elif coords[1,k+1]<0: 
-            coords[1,k+1]=-coords[1,k+1]
-            coords[0,k+1]=coords[0,k+1]+np.pi
-        if coords[0,k+1]>2*np.pi: coords[0,k+1]-=2*np.pi
-        elif coords[0,k+1]<0: coords[0,k+1]+=2*np.pi
-    try:
-        br = fnr(coords[:,-1])
-    except ValueError:
-        coords[:,-1]=coords[:,-2]
-    return coords
+import loopnet_rayleigh as lr
+import loopnet_integrate as li
+import loopnet_interp as lin
+import loopnet_shared as lsh
 
 #Converts a 3xN array of phi,theta,r values to a 3xN array of x,y,z values 
 def sphToCart(a):
@@ -50,44 +24,86 @@ def sphToCart(a):
     return x
 
 #r_cyl,z,vr,br,bh,S-<S>,beta
-def computeTrainingData(rs,fBr,fBt,fBp,fvr,fS,fP,norms,nds,r,theta,phi,rstar):
-    dat = np.zeros((10,nds+1))
-    r_cyl = rs[2,:]*np.sin(rs[1,:])
-    z = np.abs(rs[2,:]*np.cos(rs[1,:]))
-    vr = np.array([fvr(rs[:,k]) for k in range(nds+1)])
-    Br = np.array([fBr(rs[:,k]) for k in range(nds+1)])
-    Bh = np.array([np.sqrt(fBt(rs[:,k])**2+fBp(rs[:,k])**2) for k in range(nds+1)])
-    S = np.array([fS(rs[:,k])-localAverage(rs[:,k],fS,.02,r,theta,phi,rstar) for k in range(nds+1)])
-    P = np.array([fP(rs[:,k]) for k in range(nds+1)])
+#rs is a single line with shape (3,nds+1) or a batch of lines with shape (N,3,nds+1), giving (10,nds+1) or (N,10,nds+1)
+#All the fields are interpolated together in one call over every point of every line
+#fSbar is an interpolator for the precomputed smoothedAverage of S. Without it, localAverage is sampled around every point
+def computeTrainingData(rs,fBr,fBt,fBp,fvr,fS,fP,norms,nds,r,theta,phi,rstar,fSbar=None):
+    single = np.ndim(rs) == 2
+    rs = np.reshape(rs,(-1,3,nds+1))
+    pts = np.transpose(rs,(0,2,1)).reshape(-1,3)
+    fns = [fBr,fBt,fBp,fvr,fS,fP]
+    if not fSbar is None: fns.append(fSbar)
+    vals = lin.stackComponents(fns)(pts).reshape(len(rs),nds+1,len(fns))
+    if fSbar is None: Sbar = localAverage(pts,fS,.02,r,theta,phi,rstar).reshape(len(rs),nds+1)
+    else: Sbar = vals[:,:,6]
+    dat = np.zeros((len(rs),10,nds+1))
+    r_cyl = rs[:,2,:]*np.sin(rs[:,1,:])
+    z = np.abs(rs[:,2,:]*np.cos(rs[:,1,:]))
+    vr = vals[:,:,3]
+    Br = vals[:,:,0]
+    Bh = np.sqrt(vals[:,:,1]**2+vals[:,:,2]**2)
+    S = vals[:,:,4]-Sbar
+    P = vals[:,:,5].copy()
     P[np.where(P<1)]=1
     Pb = (Br**2+Bh**2)/(8*np.pi)
     beta = P/Pb
-    dat[0,:]=rs[0,:]
-    dat[1,:]=rs[1,:]
-    dat[2,:]=rs[2,:]
-    dat[3,:]=r_cyl/norms[0]
-    dat[4,:]=z/norms[1]
-    dat[5,:]=vr[:,0]/norms[2]
-    dat[6,:]=Br[:,0]/norms[3]
-    dat[7,:]=Bh[:,0]/norms[4]
-    dat[8,:]=S[:,0]/norms[5]
-    dat[9,:]=np.log10(beta[:,0])/norms[6]
+    dat[:,0,:]=rs[:,0,:]
+    dat[:,1,:]=rs[:,1,:]
+    dat[:,2,:]=rs[:,2,:]
+    dat[:,3,:]=r_cyl/norms[0]
+    dat[:,4,:]=z/norms[1]
+    dat[:,5,:]=vr/norms[2]
+    dat[:,6,:]=Br/norms[3]
+    dat[:,7,:]=Bh/norms[4]
+    dat[:,8,:]=S/norms[5]
+    dat[:,9,:]=np.log10(beta)/norms[6]
+    if single: return dat[0]
     return dat
 
+#Geometry-weighted average of f over a small box around each point of ptr, a single point or an (M,3) array
+#Every sample of the box is interpolated at all the points together
 def localAverage(ptr,f,dr,r,theta,phi,rstar,npoints=5):
-    lrs = np.linspace(np.max([np.min(r),ptr[2]-rstar*dr/2]),np.min([np.max(r),ptr[2]+rstar*dr/2]),npoints)
-    lts = np.linspace(np.max([np.min(theta),ptr[1]-np.pi*dr/2]),np.min([np.max(theta),ptr[1]+np.pi*dr/2]),npoints)
-    lps = np.linspace(np.max([np.min(phi),ptr[0]-np.pi*dr]),np.min([np.max(phi),ptr[0]+np.pi*dr]),npoints)
-    geom = np.expand_dims(lrs**2,axis=0)*np.expand_dims(np.sin(lts),axis=1)*(dr/(npoints-1))**3*rstar*2*np.pi**2
+    ptr = np.reshape(ptr,(-1,3))
+    lrs = np.linspace(np.maximum(np.min(r),ptr[:,2]-rstar*dr/2),np.minimum(np.max(r),ptr[:,2]+rstar*dr/2),npoints,axis=1)
+    lts = np.linspace(np.maximum(np.min(theta),ptr[:,1]-np.pi*dr/2),np.minimum(np.max(theta),ptr[:,1]+np.pi*dr/2),npoints,axis=1)
+    lps = np.linspace(np.maximum(np.min(phi),ptr[:,0]-np.pi*dr),np.minimum(np.max(phi),ptr[:,0]+np.pi*dr),npoints,axis=1)
+    geom = np.expand_dims(lrs**2,axis=1)*np.expand_dims(np.sin(lts),axis=2)*(dr/(npoints-1))**3*rstar*2*np.pi**2
     ave = 0
     GEOM = 0
     for i in range(npoints):
         for j in range(npoints):
             for k in range(npoints):
-                 GEOM = GEOM + geom[j,i]
-                 ave = ave + f([lps[k],lts[j],lrs[i]])*geom[j,i]
+                 GEOM = GEOM + geom[:,j,i]
+                 ave = ave + np.reshape(f(np.stack((lps[:,k],lts[:,j],lrs[:,i]),axis=1)),-1)*geom[:,j,i]
     return ave/GEOM
     
+#Builds a sparse matrix averaging a field over a window of npoints samples centred on each node of an ascending grid
+#The window is clipped to the grid and the samples are weighted by weight(samples), as in localAverage
+def windowMatrix(grid,halfwidth,weight,npoints=5):
+    n = len(grid)
+    lo = np.maximum(np.min(grid),grid-halfwidth)
+    hi = np.minimum(np.max(grid),grid+halfwidth)
+    samples = np.linspace(lo,hi,npoints,axis=1)
+    w = weight(samples)
+    w = w/np.sum(w,axis=1,keepdims=True)
+    idx = np.clip(np.searchsorted(grid,samples,side='right')-1,0,n-2)
+    t = (samples-grid[idx])/(grid[idx+1]-grid[idx])
+    rows = np.repeat(np.arange(n),npoints)
+    return csr_matrix((np.append((w*(1-t)).ravel(),(w*t).ravel()),(np.append(rows,rows),np.append(idx.ravel(),idx.ravel()+1))),shape=(n,n))
+
+#Precomputes localAverage for every node of the grid as a separable, geometry-weighted box filter
+#Because the trilinear samples and the r^2 sin(theta) weights both factor by axis, the filtered field matches
+#localAverage exactly at the grid nodes, and interpolating it replaces the 125 samples per point with one
+def smoothedAverage(f,dr,r,theta,phi,rstar,npoints=5,out=None):
+    Ar = windowMatrix(r,rstar*dr/2,lambda x: x**2,npoints)
+    At = windowMatrix(theta,np.pi*dr/2,np.sin,npoints)
+    Ap = windowMatrix(phi,np.pi*dr,np.ones_like,npoints)
+    tmp = np.empty(np.shape(f))
+    for k in range(len(phi)): tmp[k,:,:] = (Ar @ (At @ f[k,:,:]).T).T
+    if out is None: out = np.empty(np.shape(f))
+    out[...] = (Ap @ tmp.reshape(len(phi),-1)).reshape(np.shape(f))
+    return out
+
 def buildCMap(vals,colors):
     colors = np.array(colors)
     nrgba = len(colors[0,:])
@@ -113,6 +129,43 @@ def determineColors(data,polarity): #data should have shape (nvar x nds+1), and
             elif polarity[k] == 2: c[k,j,:] = [bimap[0](data[k,j]),bimap[1](data[k,j]),bimap[2](data[k,j])]
     return c #c has shape (nvars x nds x 3)
 
+#State of a worker integrating shards of field lines, set up once by initShardWorker
+_shard = {}
+
+#Prepares a worker to integrate shards of field lines, from a shared memory spec or (in the serial case) the fields themselves
+def initShardWorker(fields,params):
+    global _shard
+    if isinstance(fields,tuple):
+        fields,shm = lsh.attachShared(fields)
+        _shard = {'shm':shm}
+    else: _shard = {}
+    _shard.update(params)
+    _shard['fn'] = lin.TrilinearInterpolator((params['phi'],params['theta'],params['r']),fields)
+
+#Integrates shard number j of n field lines, each seeded uniformly within the bounds, and returns their training data
+#The seeds come from a random stream that depends only on the seed and j, so the lines do not depend on the number of workers
+#Also returns the indices (within the shard) at which seeds were rejected
+def integrateShard(shard):
+    j,n = shard
+    p = _shard
+    fn = p['fn']
+    fnr,fnt,fnp,fnvr,fnS,fnP = [fn.component(k) for k in range(6)]
+    fnSbar = fn.component(6) if p['smoothS'] else None
+    fnB = fn.select([0,1,2])
+    rng = np.random.default_rng(np.random.SeedSequence(p['seed']+[j]))
+    dat = np.zeros((n,10,p['nds']+1))
+    rejected = []
+    k = 0
+    while k < n:
+        x = rng.random((n-k,3))*(p['hi']-p['lo'])+p['lo']
+        lines = li.integrateSeeds(p['s'],p['nds'],x,fnB,p['order'],p['phi'],p['theta'],p['r'])
+        ok = np.logical_not(np.all(lines[:,:,0] == lines[:,:,-1],axis=1))
+        for i in np.where(np.logical_not(ok))[0]: rejected.append(k+np.sum(ok[:i]))
+        lines = lines[ok]
+        dat[k:k+len(lines),:,:] = computeTrainingData(lines,fnr,fnt,fnp,fnvr,fnS,fnP,p['norms'],p['nds'],p['r'],p['theta'],p['phi'],p['rstar'],fnSbar)
+        k += len(lines)
+    return dat,rejected
+
 def integrateLines(fname,config):
     fname_pref = config['FIELD_LINES_PREFIX']
     direc = config['FIELD_LINES_PATH']
@@ -129,6 +182,11 @@ def integrateLines(fname,config):
     norms = config['FIELD_LINE_INITIAL_NORMS']
     plotty = config['WRITE_IMAGES']
     verbose = config['VERBOSE']
+    smoothS = config['FIELD_LINE_SMOOTHED_ENTROPY']
+    ncheck = config['FIELD_LINE_ENTROPY_CHECK_POINTS']
+    nworkers = config['MULTITHREADING_WORKERS_PER_FILE']
+    nshard = config['FIELD_LINE_SHARD_SIZE']
+    rseed = config['FIELD_LINE_RANDOM_SEED']
 
     ref = ReferenceState()
     Pbar = np.expand_dims(np.expand_dims(ref.pressure[::-1],axis=0),axis=0)
@@ -137,59 +195,17 @@ def integrateLines(fname,config):
     monomap = buildCMap([0,1],[[0.4,0,0.7],[1,0.8,0]])
     bimap = buildCMap([-1,0,1],[[0,0,1],[0.7,0.7,0.7],[1,0,0]])
 
-    training_data = np.zeros((nlines,10,nds+1))
     if verbose: print('Working on file {:s}...'.format(fname))
-    #Reading the files
-    f = open(dir3d+fname+'_grid','rb')
-    skipbyte = np.fromfile(f,count=1,dtype=np.int32)
-    nr = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nt = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nphi = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    r = np.fromfile(f,count=nr,dtype=np.float64)[::-1]
-    try: overlap_ind = np.where(r[1:]==r[:-1])[0][0]
-    except IndexError: overlap_ind = None
-    if not overlap_ind is None: r = np.append(r[:overlap_ind],r[overlap_ind+1:])
-    skipbyte = np.fromfile(f,count=1,dtype=np.float64)
-    theta = np.fromfile(f,count=nt,dtype=np.float64)[::-1]
-    phi = np.linspace(0,2*np.pi,nphi+1)
-    f.close()
-    nB = nr*nt*nphi
-
-    f = open(dir3d+fname+'_0801','rb')
-    Br = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Br = np.append(Br[:,:,:overlap_ind],Br[:,:,overlap_ind+1:],axis=2)
-    Br = np.append(Br,np.expand_dims(Br[0,:,:],axis=0),axis=0)
-    f.close()
-    f = open(dir3d+fname+'_0802','rb')
-    Bt = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Bt = np.append(Bt[:,:,:overlap_ind],Bt[:,:,overlap_ind+1:],axis=2)
-    Bt = np.append(Bt,np.expand_dims(Bt[0,:,:],axis=0),axis=0)
-    f.close()
-    f = open(dir3d+fname+'_0803','rb')
-    Bp = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: Bp = np.append(Bp[:,:,:overlap_ind],Bp[:,:,overlap_ind+1:],axis=2)
-    Bp = np.append(Bp,np.expand_dims(Bp[0,:,:],axis=0),axis=0)
-    f.close()
-
-    f = open(dir3d+fname+'_0001','rb')
-    vr = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: vr = np.append(vr[:,:,:overlap_ind],vr[:,:,overlap_ind+1:],axis=2)
-    vr = np.append(vr,np.expand_dims(vr[0,:,:],axis=0),axis=0)
-    f.close()
-
-    f = open(dir3d+fname+'_0501','rb')
-    S = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: S = np.append(S[:,:,:overlap_ind],S[:,:,overlap_ind+1:],axis=2)
-    S = np.append(S,np.expand_dims(S[0,:,:],axis=0),axis=0)
-    f.close()
-    f = open(dir3d+fname+'_0502','rb')   
-    P = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: P = np.append(P[:,:,:overlap_ind],P[:,:,overlap_ind+1:],axis=2)
-    P = np.append(P,np.expand_dims(P[0,:,:],axis=0),axis=0)
-    f.close()
+    #Reading the files, straight into shared memory when the lines are shared out between several workers
+    grid = lr.readGrid(dir3d,fname)
+    r = grid['r']
+    theta = grid['theta']
+    phi = grid['phi']
+    shape = lr.fieldsShape(grid,6+1*smoothS)
+    if nworkers > 1: fields,shm,spec = lsh.createShared(shape)
+    else: fields = np.empty(shape)
+    lr.readFields(dir3d,fname,['0801','0802','0803','0001','0501','0502'],grid,out=fields[...,:6])
+    if smoothS: smoothedAverage(fields[...,4],.02,r,theta,phi,rstar,out=fields[...,6])
 
     if rbnds[0]<np.min(r): rbnds[0] = np.min(r)
     if rbnds[1]>np.max(r): rbnds[1] = np.max(r)
@@ -198,32 +214,30 @@ def integrateLines(fname,config):
     if pbnds[0]<np.min(phi): pbnds[0] = np.min(phi)
     if pbnds[1]>np.max(phi): pbnds[1] = np.max(phi)
 
-    fnr = rgi((phi,theta,r),Br)
-    fnt = rgi((phi,theta,r),Bt)
-    fnp = rgi((phi,theta,r),Bp)
-
-    fnvr = rgi((phi,theta,r),vr)
-
-    fnS = rgi((phi,theta,r),S)
-    fnP = rgi((phi,theta,r),P)
+    if rseed is None: rseed = int(time.time())
+    seed((rseed+int(fname)) % 2**32)
 
-    seed(int(time.time())+int(fname))
+    #Calculating all the field lines, in shards of seeds that each draw from their own random stream
+    params = {'phi':phi,'theta':theta,'r':r,'rstar':rstar,'s':s,'nds':nds,'order':order,'norms':norms,'smoothS':smoothS,
+              'lo':np.array([pbnds[0],tbnds[0],rbnds[0]]),'hi':np.array([pbnds[1],tbnds[1],rbnds[1]]),'seed':[rseed,int(fname)]}
+    shards = [(j,min(nshard,nlines-j*nshard)) for j in range(int(np.ceil(nlines/nshard)))]
+    if nworkers > 1:
+        try:
+            with mp.Pool(min(nworkers,len(shards)),initializer=initShardWorker,initargs=(spec,params)) as pool: results = pool.map(integrateShard,shards)
+        finally:
+            del fields
+            lsh.releaseShared(shm,unlink=True)
+    else:
+        initShardWorker(fields,params)
+        results = [integrateShard(shard) for shard in shards]
+    training_data = np.concatenate([res[0] for res in results],axis=0)
+    for j in range(len(shards)):
+        for k in results[j][1]: print(' rejecting field line {:d}'.format(j*nshard+k))
 
-    #Calculating all the field lines
-    k = 0
-    while k < nlines:
-        x = rand(3)*np.array([pbnds[1]-pbnds[0],tbnds[1]-tbnds[0],rbnds[1]-rbnds[0]])+np.array([pbnds[0],tbnds[0],rbnds[0]])
-        if order=='fwd': rs = calcFieldLine(s,nds,x,fnr,fnt,fnp,1)
-        elif order=='back': rs = calcFieldLine(s,nds,x,fnr,fnt,fnp,-1)
-        elif order=='fab': rs = np.append(calcFieldLine(s/2.,int(nds/2),x,fnr,fnt,fnp,-1)[:,::-1],calcFieldLine(s/2.,int(nds/2),x,fnr,fnt,fnp,1),axis=1)
-        if (rs[:,0] == rs[:,-1]).all(): print(' rejecting field line {:d}'.format(k))
-        else: 
-            training_data[k,:,:] = computeTrainingData(rs,fnr,fnt,fnp,fnvr,fnS,fnP,norms,nds,r,theta,phi,rstar)
-            k += 1
-
-        if plotty:
+    if plotty:
+        for k in range(nlines):
             colors = determineColors(training_data[k,5:,:],[2,2,1,2,1])
-            xs = sphToCart(rs)/rstar
+            xs = sphToCart(training_data[k,:3,:])/rstar
             fig, axs = plt.subplots(5,2,figsize=(6,15),dpi=100,tight_layout=True)
             for j in range(5):
                 axs[j,0].plot(circlex,circley,'k--')
@@ -239,6 +253,23 @@ def integrateLines(fname,config):
             plt.savefig('{:s}{:s}_f{:s}_l{:04d}.png'.format(dirfig,fname_pref,fname,k))
             plt.close('all')
 
+    #Compare the smoothed entropy against localAverage on random points of the lines, to make sure trained models still apply
+    #The shared fields are gone after a parallel run, so the entropy is read and smoothed again
+    if smoothS and ncheck > 0:
+        if nworkers > 1:
+            fields = lr.readFields(dir3d,fname,['0501'],grid,extra=1)
+            smoothedAverage(fields[...,0],.02,r,theta,phi,rstar,out=fields[...,1])
+            fn = lin.TrilinearInterpolator((phi,theta,r),fields)
+            fnS,fnSbar = fn.component(0),fn.component(1)
+        else: fnS,fnSbar = _shard['fn'].component(4),_shard['fn'].component(6)
+        pts = training_data[randint(nlines,size=ncheck),:3,randint(nds+1,size=ncheck)]
+        local = localAverage(pts,fnS,.02,r,theta,phi,rstar)
+        smooth = fnSbar(pts)
+        dev = fnS(pts)-local
+        print('File {:s}: smoothed <S> differs from localAverage by at most {:.3e} (mean {:.3e}) over {:d} points, where |S-<S>| has rms {:.3e}'.format(fname,np.max(np.abs(smooth-local)),np.mean(np.abs(smooth-local)),ncheck,np.sqrt(np.mean(dev**2))))
+    #a worker process can go on to other files, so it should not keep this one's fields
+    _shard.clear()
+
     np.save('{:s}{:s}_f{:s}'.format(direc,fname_pref,fname),training_data,allow_pickle=False,fix_imports=False)
 
 
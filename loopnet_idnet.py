@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as nnf
+from loopnet_features import computeCurvature
 
 #Channels are r,t,p,rcyl,z,Br,Bh,vr,S-<S>, beta, and k
 #Initial length is 400
@@ -36,23 +37,6 @@ def rectifyPhis(phis):
         phis[k,:] = phis[k,:] - phis[k,0]
     return phis
 
-def computeCurvature(rs): #assumes rs has shape nlines x 3 x nds+1
-    dp = np.append(rs[:,0,1:] - rs[:,0,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    dt = np.append(rs[:,1,1:] - rs[:,1,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    dr = np.append(rs[:,2,1:] - rs[:,2,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    Tr = dr
-    Tt = dt*rs[:,2,:]
-    Tp = dp*rs[:,2,:]*np.sin(rs[:,1,:]) 
-    ds = np.sqrt(Tr**2+Tt**2+Tp**2)
-    ds[np.where(ds == 0)] = np.max(ds)
-    dTr = np.append(np.zeros((len(rs[:,0,0]),1)),Tr[:,1:]-Tr[:,:-1],axis=1)
-    dTt = np.append(np.zeros((len(rs[:,0,0]),1)),Tt[:,1:]-Tt[:,:-1],axis=1)
-    dTp = np.append(np.zeros((len(rs[:,0,0]),1)),Tp[:,1:]-Tp[:,:-1],axis=1)
-    curvature = np.sqrt(dTr**2+dTt**2+dTp**2)/ds**2
-    curvature[np.where(np.isnan(curvature))] = 0
-    curvature = np.cbrt(curvature) * np.sign(dTr)
-    return curvature
-
 def compileData(file_list,exclude = None,normalize = True):
     data = None
     for fname in file_list:
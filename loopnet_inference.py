@@ -0,0 +1,156 @@
+import numpy as np
+import os
+import multiprocessing as mp
+from multiprocessing import resource_tracker
+import queue
+import time
+import traceback
+import loopnet_shared as lsh
+
+#models loaded by this process, keyed by the config entries that define them
+_models = {}
+#connection to the inference server set up by initClient, empty if this process runs the models itself
+_client = {}
+
+#Runs net over an array of lines with shape (N, nvar, L) in mini-batches of batchsize, without building autograd graphs
+#Every batch is copied into the same preallocated float32 tensor, and forward(net,x) gives the per-batch output to keep
+#returns a numpy array with the outputs of all N lines stacked along the first axis
+def batchedInference(net,lines,batchsize,forward=lambda net,x: net(x)):
+    import torch
+    N = np.shape(lines)[0]
+    batchsize = max(1,min(int(batchsize),N))
+    buf = torch.empty((batchsize,)+tuple(np.shape(lines)[1:]),dtype=torch.float32)
+    out = None
+    net.eval()
+    with torch.inference_mode():
+        for k in range(0,N,batchsize):
+            n = min(batchsize,N-k)
+            buf[:n].copy_(torch.from_numpy(np.ascontiguousarray(lines[k:k+n])))
+            res = forward(net,buf[:n]).numpy()
+            if out is None: out = np.empty((N,)+np.shape(res)[1:],dtype=res.dtype)
+            out[k:k+n] = res
+    if out is None: out = np.empty((0,),dtype=np.float32)
+    return out
+
+#Returns the IdNet score of each line, where lines has shape (N, nvar, L)
+def idnetScores(idnet,lines,batchsize):
+    return batchedInference(idnet,lines,batchsize,lambda net,x: net(x)[:,1])
+
+#Returns the SegNet class of each point of each line, an integer array with shape (N, L)
+#segnet is either a WNet or an encoder-only model, both of which return the class probabilities when called on lines alone
+def segnetMasks(segnet,lines,batchsize):
+    import torch
+    masks = batchedInference(segnet,lines,batchsize,lambda net,x: torch.argmax(net(x),dim=1))
+    if masks.ndim == 1: masks = np.zeros((0,np.shape(lines)[-1]),dtype=np.int64)
+    return masks
+
+#Path of the exported variant of the saved model name, written by loopnet_export.exportModels
+def variantPath(name,variant):
+    return os.path.splitext(name)[0]+'_'+variant+'.pt'
+
+#Builds idnet and segnet from the saved models named in config and puts them in eval mode, once per process
+#INFERENCE_VARIANT 'fp32' uses the eager models (segnet reduced to its encoder), any other value loads the TorchScript
+#models exported for that variant by loopnet_export.exportModels
+#returns (idnet, segnet)
+def loadModels(config):
+    variant = config['INFERENCE_VARIANT']
+    key = (config['IDNET_NAME'],config['SEGNET_NAME'],config['SEGNET_NUM_CLASS'],tuple(config['SEGNET_EXCLUDE_FEATURES']),variant)
+    if not key in _models:
+        import torch
+        if variant == 'fp32':
+            import loopnet_idnet as cnn
+            import loopnet_segnet as wnet
+            idnet = cnn.Net()
+            idnet.load_state_dict(torch.load(config['IDNET_NAME']))
+            segnet = wnet.WNet(K=config['SEGNET_NUM_CLASS'],nvar=11-len(config['SEGNET_EXCLUDE_FEATURES']))
+            segnet.load_state_dict(torch.load(config['SEGNET_NAME']))
+            segnet = wnet.WNetEncoder(segnet)
+        else:
+            idnet = torch.jit.load(variantPath(config['IDNET_NAME'],variant))
+            segnet = torch.jit.load(variantPath(config['SEGNET_NAME'],variant))
+        _models[key] = (idnet.eval(),segnet.eval())
+    return _models[key]
+
+#Main loop of the inference server started by startServer
+#Each request is (slot, number, kind, inspec, outspec): the lines and the output array live in shared memory made by the client,
+#kind is 'score' or 'segment', and the reply on responses[slot] is (number, '') on success or (number, traceback) on failure
+#A request of None stops the server
+def serveModels(config,requests,responses):
+    error = ''
+    try: idnet,segnet = loadModels(config)
+    except BaseException: error = traceback.format_exc()
+    batchsize = config['INFERENCE_BATCH_SIZE']
+    while True:
+        req = requests.get()
+        if req is None: break
+        slot,number,kind,inspec,outspec = req
+        try:
+            if error: raise RuntimeError('The models could not be loaded:\n'+error)
+            lines,inshm = lsh.attachShared(inspec)
+            out,outshm = lsh.attachShared(outspec)
+            if kind == 'score': out[:] = idnetScores(idnet,lines,batchsize)
+            elif kind == 'segment': out[:] = segnetMasks(segnet,lines,batchsize)
+            else: raise ValueError('Unknown inference request {:s}'.format(str(kind)))
+            del lines,out
+            lsh.releaseShared(inshm)
+            lsh.releaseShared(outshm)
+            responses[slot].put((number,''))
+        except BaseException: responses[slot].put((number,traceback.format_exc()))
+
+#Starts a process that loads both models once and serves every worker that joins it through initClient
+#nslots is the number of workers that can be connected at once, each through its own response queue
+#returns a dict holding the server process, its queues, and the initargs to pass along with initClient
+def startServer(config,nslots):
+    requests = mp.Queue()
+    responses = [mp.Queue() for k in range(nslots)]
+    slots = mp.Queue()
+    for k in range(nslots): slots.put(k)
+    #the shared blocks of a request are registered by both ends, so they have to share the parent's resource tracker
+    resource_tracker.ensure_running()
+    proc = mp.Process(target=serveModels,args=(config,requests,responses),daemon=True)
+    proc.start()
+    return {'process':proc,'requests':requests,'responses':responses,'slots':slots,'initargs':(requests,responses,slots,config['INFERENCE_SERVER_TIMEOUT'])}
+
+#Asks the server to finish the requests already queued and waits for it to exit
+def stopServer(server):
+    server['requests'].put(None)
+    server['process'].join()
+
+#Worker pool initializer connecting the worker to an inference server, with initargs from startServer
+#if no slot is free (e.g. in a pool that replaced a broken one) the worker loads its own models instead
+def initClient(requests,responses,slots,timeout):
+    try: slot = slots.get(timeout=1)
+    except queue.Empty: return
+    _client.update({'requests':requests,'response':responses[slot],'slot':slot,'timeout':timeout,'number':0})
+
+#Sends lines to the inference server and waits for the result, an array with shape outshape
+#requests are numbered, so that a late reply to a request that timed out is dropped rather than taken for this one
+def serverRequest(kind,lines,outshape,outdtype):
+    inarr,inshm,inspec = lsh.createShared(np.shape(lines),np.float32)
+    out,outshm,outspec = lsh.createShared(outshape,outdtype)
+    try:
+        inarr[:] = lines
+        _client['number'] += 1
+        _client['requests'].put((_client['slot'],_client['number'],kind,inspec,outspec))
+        deadline = time.time()+_client['timeout'] if _client['timeout'] else None
+        number = None
+        while not number == _client['number']:
+            try: number,msg = _client['response'].get(timeout=max(0,deadline-time.time()) if deadline else None)
+            except queue.Empty: raise RuntimeError('The inference server did not answer within {:.0f} s'.format(_client['timeout']))
+        if msg: raise RuntimeError('The inference server failed:\n'+msg)
+        res = out.copy()
+    finally:
+        del inarr,out
+        lsh.releaseShared(inshm,unlink=True)
+        lsh.releaseShared(outshm,unlink=True)
+    return res
+
+#Returns the IdNet score of each line, from the inference server if this worker is connected to one
+def scoreLines(config,lines):
+    if 'slot' in _client: return serverRequest('score',lines,(np.shape(lines)[0],),np.float32)
+    return idnetScores(loadModels(config)[0],lines,config['INFERENCE_BATCH_SIZE'])
+
+#Returns the SegNet class of each point of each line, from the inference server if this worker is connected to one
+def segmentLines(config,lines):
+    if 'slot' in _client: return serverRequest('segment',lines,(np.shape(lines)[0],np.shape(lines)[-1]),np.int64)
+    return segnetMasks(loadModels(config)[1],lines,config['INFERENCE_BATCH_SIZE'])
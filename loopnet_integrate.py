@@ -0,0 +1,95 @@
+import numpy as np
+import loopnet_interp as lin
+
+#Combines separate interpolating functions for Br, Btheta and Bphi into a single function returning an (M,3) array
+def stackInterpolators(fnr,fnt,fnp):
+    return lin.stackComponents([fnr,fnt,fnp])
+
+#Reflects an (N,3) array of phi,theta,r seeds that fall outside the grid back into the domain
+def reflectSeeds(X0,theta,r):
+    X0 = np.array(X0,dtype=np.float64).reshape(-1,3)
+    minr = np.min(r)
+    maxr = np.max(r)
+    mint = np.min(theta)
+    maxt = np.max(theta)
+    hi = X0[:,1]>maxt
+    lo = np.logical_and(np.logical_not(hi),X0[:,1]<mint)
+    X0[hi,1] = 2*maxt-X0[hi,1]
+    X0[lo,1] = -X0[lo,1]
+    X0[np.logical_or(hi,lo),0] += np.pi
+    hi = X0[:,0]>2*np.pi
+    lo = X0[:,0]<0
+    X0[hi,0] -= 2*np.pi
+    X0[lo,0] += 2*np.pi
+    hi = X0[:,2]>maxr
+    lo = X0[:,2]<minr
+    X0[hi,2] = 2*maxr-X0[hi,2]
+    X0[lo,2] = 2*minr-X0[lo,2]
+    return X0
+
+#Calculates streamlines with steps of length ds (one per line, signed by direction) from an (N,3) array of seeds X0
+#fnB maps an (M,3) array of phi,theta,r positions to an (M,3) array of Br,Btheta,Bphi
+#Lines that leave the grid are frozen at their last valid point, exactly as the single-line integrator did
+#Returns an array with shape (N,3,nds+1)
+def integrateSteps(nds,X0,ds,fnB,phi,theta,r):
+    X0 = np.array(X0,dtype=np.float64).reshape(-1,3)
+    N = np.shape(X0)[0]
+    ds = np.broadcast_to(np.asarray(ds,dtype=np.float64),(N,))
+    lo = np.array([phi[0],theta[0],r[0]])
+    hi = np.array([phi[-1],theta[-1],r[-1]])
+    coords = np.zeros((N,3,nds+1))
+    coords[:,:,0] = X0
+    active = np.arange(N)
+    for k in range(nds):
+        x = coords[active,:,k]
+        inb = np.all(np.logical_and(x>=lo,x<=hi),axis=1)
+        if not np.all(inb):
+            out = active[np.logical_not(inb)]
+            coords[out,:,k:] = coords[out,:,k-1][:,:,np.newaxis]
+            active = active[inb]
+            x = x[inb]
+            if len(active) == 0: return coords
+        B = fnB(x)
+        br = B[:,0]
+        bt = B[:,1]
+        bp = B[:,2]
+        Bmag = np.sqrt(br**2+bt**2+bp**2)
+        x = x+(ds[active]/Bmag)[:,np.newaxis]*np.stack((bp/np.abs(x[:,2]*np.sin(x[:,1])),bt/x[:,2],br),axis=1)
+        over = x[:,1]>np.pi
+        under = x[:,1]<0
+        x[over,1] = 2*np.pi-x[over,1]
+        x[under,1] = -x[under,1]
+        x[np.logical_or(over,under),0] += np.pi
+        over = x[:,0]>2*np.pi
+        under = x[:,0]<0
+        x[over,0] -= 2*np.pi
+        x[under,0] += 2*np.pi
+        coords[active,:,k+1] = x
+    x = coords[active,:,-1]
+    out = active[np.logical_not(np.all(np.logical_and(x>=lo,x<=hi),axis=1))]
+    if nds > 0: coords[out,:,-1] = coords[out,:,-2]
+    return coords
+
+#Calculates streamlines of length s from an (N,3) array of seeds, in the direction given by the sign of mult
+def calcFieldLines(s,nds,X0,fnB,mult,phi,theta,r):
+    return integrateSteps(nds,X0,s/nds*np.asarray(mult,dtype=np.float64),fnB,phi,theta,r)
+
+#Integrates every seed backwards by s_back in nds_back steps and forwards by s_fwd in nds_fwd steps as one batch
+#Returns the backward lines (in integration order, starting at the seed) and the forward lines separately
+def calcFieldLinesBidirectional(s_back,nds_back,s_fwd,nds_fwd,X0,fnB,phi,theta,r):
+    X0 = np.array(X0,dtype=np.float64).reshape(-1,3)
+    N = np.shape(X0)[0]
+    ds = np.zeros(2*N)
+    if nds_back > 0: ds[:N] = -s_back/nds_back
+    if nds_fwd > 0: ds[N:] = s_fwd/nds_fwd
+    lines = integrateSteps(max(nds_back,nds_fwd),np.append(X0,X0,axis=0),ds,fnB,phi,theta,r)
+    return lines[:N,:,:nds_back+1],lines[N:,:,:nds_fwd+1]
+
+#Integrates a population of seeds according to FIELD_LINE_INTEGRATION_ORDER ('fwd', 'back' or 'fab')
+def integrateSeeds(s,nds,X0,fnB,order,phi,theta,r):
+    if order == 'fwd': return calcFieldLines(s,nds,X0,fnB,1,phi,theta,r)
+    elif order == 'back': return calcFieldLines(s,nds,X0,fnB,-1,phi,theta,r)
+    elif order == 'fab':
+        back,fwd = calcFieldLinesBidirectional(s/2.,int(nds/2),s/2.,int(nds/2),X0,fnB,phi,theta,r)
+        return np.append(back[:,:,::-1],fwd,axis=2)
+    else: raise ValueError('Unknown integration order {:s}'.format(str(order)))
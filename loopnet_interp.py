@@ -0,0 +1,105 @@
+import numpy as np
+
+#Locates the cells containing positions along one ascending grid axis without a binary search
+#Uniform axes (like phi) compute the index directly. Other axes use a table over uniform bins no wider than the
+#narrowest cell, so the tabulated index is at most one cell away from the right one.
+class GridAxis:
+    def __init__(self,grid,maxbins=1<<20):
+        self.grid = np.asarray(grid,dtype=np.float64)
+        self.n = len(self.grid)
+        self.lo = self.grid[0]
+        self.hi = self.grid[-1]
+        self.dgrid = np.diff(self.grid)
+        if np.any(self.dgrid <= 0): raise ValueError('Grid axes must be strictly ascending')
+        self.uniform = np.allclose(self.dgrid,self.dgrid[0],rtol=1e-10,atol=0)
+        if self.uniform: self.nbins = self.n-1
+        else: self.nbins = int(min(maxbins,np.ceil((self.hi-self.lo)/np.min(self.dgrid))+1))
+        self.binscale = self.nbins/(self.hi-self.lo)
+        if not self.uniform:
+            edges = self.lo+np.arange(self.nbins)/self.binscale
+            self.table = np.clip(np.searchsorted(self.grid,edges,side='right')-1,0,self.n-2)
+
+    #returns the lower cell index and the fractional position within the cell for each x
+    def locate(self,x):
+        b = np.clip(np.floor((x-self.lo)*self.binscale).astype(np.intp),0,self.nbins-1)
+        if self.uniform: idx = np.minimum(b,self.n-2)
+        else:
+            idx = self.table[b]
+            up = np.logical_and(idx < self.n-2,x >= self.grid[np.minimum(idx+1,self.n-1)])
+            while np.any(up):
+                idx[up] += 1
+                up = np.logical_and(idx < self.n-2,x >= self.grid[np.minimum(idx+1,self.n-1)])
+            down = np.logical_and(idx > 0,x < self.grid[idx])
+            while np.any(down):
+                idx[down] -= 1
+                down = np.logical_and(idx > 0,x < self.grid[idx])
+        return idx,(x-self.grid[idx])/self.dgrid[idx]
+
+#Trilinear interpolation of a stacked field with shape (nphi+1, nt, nr, ncomp) on the (phi,theta,r) grid
+#Cell indices and weights are computed once per query point and shared by every component
+#Like RegularGridInterpolator, queries outside the grid raise a ValueError unless bounds_error is False
+class TrilinearInterpolator:
+    def __init__(self,points,values,bounds_error=True,fill_value=np.nan):
+        self.axes = [GridAxis(p) for p in points]
+        shape = tuple(a.n for a in self.axes)
+        if not np.shape(values)[:3] == shape: raise ValueError('Values with shape {:s} do not match the grid {:s}'.format(str(np.shape(values)),str(shape)))
+        self.scalar = np.ndim(values) == 3
+        self.ncomp = 1 if self.scalar else np.shape(values)[3]
+        self.values = np.ascontiguousarray(values).reshape(-1,self.ncomp)
+        self.bounds_error = bounds_error
+        self.fill_value = fill_value
+        self.strides = np.array([shape[1]*shape[2],shape[2],1])
+        self.corners = np.array([[i,j,k] for i in [0,1] for j in [0,1] for k in [0,1]])
+        self.offsets = self.corners @ self.strides
+
+    #interpolates the components listed in comps (all of them by default) at an (M,3) array of phi,theta,r positions
+    #returns an (M,ncomp) array, or (M,) for a field that was not stacked
+    def __call__(self,x,comps=None):
+        x = np.asarray(x,dtype=np.float64).reshape(-1,3)
+        inb = np.ones(len(x),dtype=bool)
+        for d in range(3):
+            dinb = np.logical_and(x[:,d] >= self.axes[d].lo,x[:,d] <= self.axes[d].hi)
+            if self.bounds_error and not np.all(dinb): raise ValueError('One of the requested xi is out of bounds in dimension {:d}'.format(d))
+            inb = np.logical_and(inb,dinb)
+        base = np.zeros(len(x),dtype=np.intp)
+        t = np.zeros((len(x),3))
+        for d in range(3):
+            idx,t[:,d] = self.axes[d].locate(x[:,d])
+            base += idx*self.strides[d]
+        w = [np.stack((1-t[:,d],t[:,d]),axis=1) for d in range(3)]
+        w = (w[0][:,:,np.newaxis,np.newaxis]*w[1][:,np.newaxis,:,np.newaxis]*w[2][:,np.newaxis,np.newaxis,:]).reshape(-1,8)
+        w = w.T[:,:,np.newaxis]
+        corners = self.offsets[:,np.newaxis]+base[np.newaxis,:]
+        if comps is None: vals = np.take(self.values,corners,axis=0)
+        else: vals = np.take(self.values.ravel(),corners[:,:,np.newaxis]*self.ncomp+np.asarray(comps,dtype=np.intp))
+        #the corners are summed in a fixed order so that a component gives the same bits whichever others are requested
+        out = w[0]*vals[0]
+        for c in range(1,8): out += w[c]*vals[c]
+        if not np.all(inb): out[np.logical_not(inb),:] = self.fill_value
+        if self.scalar and comps is None: return out[:,0]
+        return out
+
+    #returns a callable evaluating only the listed components, e.g. select([0,1,2]) for the magnetic field
+    def select(self,comps):
+        return InterpolatorComponent(self,comps)
+
+    #returns a callable for a single component, a drop-in replacement for a scalar RegularGridInterpolator
+    def component(self,comp):
+        return InterpolatorComponent(self,comp)
+
+#A view onto one or several components of a TrilinearInterpolator
+class InterpolatorComponent:
+    def __init__(self,parent,comp):
+        self.parent = parent
+        self.comp = comp
+
+    def __call__(self,x):
+        if np.ndim(self.comp) == 0: return self.parent(x,comps=[self.comp])[:,0]
+        return self.parent(x,comps=self.comp)
+
+#Combines several interpolating functions into one returning an (M,len(fns)) array
+#Components of the same TrilinearInterpolator are fused so that each position is only located once
+def stackComponents(fns):
+    if np.all([isinstance(f,InterpolatorComponent) and f.parent is fns[0].parent and np.ndim(f.comp) == 0 for f in fns]):
+        return fns[0].parent.select([f.comp for f in fns])
+    return lambda x: np.stack([np.reshape(f(x),-1) for f in fns],axis=-1)
@@ -0,0 +1,50 @@
+import numpy as np
+
+#Shared kernel for sliding one line along another, as done by checkOverlap, matchLength, matchLengthGroup and scoreOverlap
+#For a shorter line a (3 x Na) and a longer line b (3 x Nb), shift k aligns a[:,i] with b[:,i+d] where d = k+nmin-Na+1,
+#for k in range(Na+Nb-2*nmin), so that every alignment shares at least nmin points
+
+#Returns the index ranges al,ar,bl,br (inclusive) of the points of a and b that are aligned by shift k
+def shiftBounds(k,Na,Nb,nmin):
+    al = np.max([0,Na-1-nmin-k])
+    ar = np.min([Na-1,Na+Nb-2-nmin-k])
+    bl = np.max([0,nmin+k-Na+1])
+    br = np.min([Nb-1,nmin+k])
+    return al,ar,bl,br
+
+#Computes, for every shift, the number of aligned point pairs within tolerance of each other (if a tolerance is given)
+#and the sum of the distances between aligned points
+#Point distances are found once for all shifts, in blocks of rows of a holding at most maxpairs distances, and are summed
+#onto their diagonals with bincount
+def shiftStats(a,b,nmin,tolerance=None,maxpairs=1<<20):
+    Na = np.shape(a)[1]
+    Nb = np.shape(b)[1]
+    nshift = max(0,Na+Nb-2*nmin)
+    dmin = nmin-Na+1
+    counts = np.zeros(nshift,dtype=np.int64)
+    sums = np.zeros(nshift)
+    if nshift == 0: return counts,sums
+    rows = max(1,maxpairs//Nb)
+    for i0 in range(0,Na,rows):
+        i1 = min(Na,i0+rows)
+        dist = np.sqrt(np.sum((a[:,i0:i1,np.newaxis]-b[:,np.newaxis,:])**2,axis=0))
+        k = np.arange(Nb)[np.newaxis,:]-np.arange(i0,i1)[:,np.newaxis]-dmin
+        valid = np.logical_and(k >= 0,k < nshift)
+        k = k[valid]
+        dist = dist[valid]
+        if not tolerance is None: counts += np.bincount(k[dist<=tolerance],minlength=nshift)
+        sums += np.bincount(k,weights=dist,minlength=nshift)
+    return counts,sums
+
+#Number of point pairs aligned by each shift
+def shiftLengths(Na,Nb,nmin):
+    d = np.arange(max(0,Na+Nb-2*nmin))+nmin-Na+1
+    return np.minimum(Na,Nb-d)-np.maximum(0,-d)
+
+#Number of aligned point pairs within tolerance for every shift
+def shiftCounts(a,b,nmin,tolerance,maxpairs=1<<20):
+    return shiftStats(a,b,nmin,tolerance,maxpairs)[0]
+
+#Mean distance between aligned points for every shift
+def shiftMeans(a,b,nmin,maxpairs=1<<20):
+    return shiftStats(a,b,nmin,None,maxpairs)[1]/shiftLengths(np.shape(a)[1],np.shape(b)[1],nmin)
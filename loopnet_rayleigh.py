@@ -0,0 +1,79 @@
+import numpy as np
+
+#Reads a Rayleigh 3D grid file and returns the grid in the orientation used throughout LoopNet
+#r and theta are flipped to be ascending, the radial point duplicated at a chebyshev domain boundary is dropped,
+#and phi includes the periodic endpoint at 2pi so that interpolation wraps cleanly
+def readGrid(dir3d,fname):
+    f = open('{:s}{:s}_grid'.format(dir3d,fname),'rb')
+    f.seek(4,1) #record marker
+    nr = int(np.fromfile(f,count=1,dtype=np.int32)[0])
+    f.seek(8,1) #record markers
+    nt = int(np.fromfile(f,count=1,dtype=np.int32)[0])
+    f.seek(8,1) #record markers
+    nphi = int(np.fromfile(f,count=1,dtype=np.int32)[0])
+    f.seek(8,1) #record markers
+    r = np.fromfile(f,count=nr,dtype=np.float64)[::-1]
+    try: overlap_ind = int(np.where(r[1:]==r[:-1])[0][0])
+    except IndexError: overlap_ind = None
+    if not overlap_ind is None: r = np.append(r[:overlap_ind],r[overlap_ind+1:])
+    f.seek(8,1) #record markers
+    theta = np.fromfile(f,count=nt,dtype=np.float64)[::-1].copy()
+    f.close()
+    phi = np.linspace(0,2*np.pi,nphi+1)
+    return {'r':r,'theta':theta,'phi':phi,'nr':nr,'nt':nt,'nphi':nphi,'overlap_ind':overlap_ind}
+
+#Reads one quantity (e.g. '0801' for Br) of a Rayleigh 3D output with shape (nphi+1, nt, nr_unique)
+#The file is memory-mapped rather than read, and the flipped, de-duplicated and phi-padded array is built with a
+#single copy into out, which can be any writable array of the right shape (e.g. one component of a stacked field)
+#The copy proceeds in radial blocks, which are contiguous in the Fortran-ordered file
+def readField(dir3d,fname,qcode,grid,out=None,rblock=16):
+    nr = grid['nr']
+    nt = grid['nt']
+    nphi = grid['nphi']
+    overlap_ind = grid['overlap_ind']
+    nru = len(grid['r'])
+    if out is None: out = np.empty((nphi+1,nt,nru),dtype=np.float64)
+
+    raw = np.memmap('{:s}{:s}_{:s}'.format(dir3d,fname,qcode),dtype=np.float64,mode='r',shape=(nphi,nt,nr),order='F')
+    #file index j ends up at flipped radial index nr-1-j, shifted down by one past the duplicated point
+    keep = np.arange(nr)[::-1]
+    if not overlap_ind is None: keep = np.append(keep[:overlap_ind],keep[overlap_ind+1:])
+    for k in range(0,nru,rblock): out[:nphi,:,k:k+rblock] = raw[:,::-1,keep[k:k+rblock]]
+    del raw
+    out[nphi,:,:] = out[0,:,:]
+    return out
+
+#Azimuthal mean of one quantity, with shape (nt, nr_unique), including the periodic endpoint, streamed from the file in
+#radial blocks so that the whole 3D array is never held in memory
+#Each block is padded in Fortran order, like the array track_loops used to read whole, so that np.mean sums along the
+#contiguous phi axis in the same (pairwise) order and gives exactly the same mean
+def meanField(dir3d,fname,qcode,grid,rblock=16):
+    nr = grid['nr']
+    nt = grid['nt']
+    nphi = grid['nphi']
+    overlap_ind = grid['overlap_ind']
+    nru = len(grid['r'])
+    out = np.empty((nt,nru),dtype=np.float64)
+
+    raw = np.memmap('{:s}{:s}_{:s}'.format(dir3d,fname,qcode),dtype=np.float64,mode='r',shape=(nphi,nt,nr),order='F')
+    keep = np.arange(nr)[::-1]
+    if not overlap_ind is None: keep = np.append(keep[:overlap_ind],keep[overlap_ind+1:])
+    for k in range(0,nru,rblock):
+        block = raw[:,::-1,keep[k:k+rblock]]
+        padded = np.empty((nphi+1,)+np.shape(block)[1:],dtype=np.float64,order='F')
+        padded[:nphi] = block
+        padded[nphi] = block[0]
+        out[:,k:k+rblock] = np.mean(padded,axis=0)
+    del raw
+    return out
+
+#Reads several quantities straight into one stacked array of shape (nphi+1, nt, nr_unique, len(qcodes)+extra)
+#extra reserves trailing components for fields derived from the ones read, and out can be any writable array of that shape
+def readFields(dir3d,fname,qcodes,grid,extra=0,out=None):
+    if out is None: out = np.empty(fieldsShape(grid,len(qcodes)+extra),dtype=np.float64)
+    for k in range(len(qcodes)): readField(dir3d,fname,qcodes[k],grid,out=out[...,k])
+    return out
+
+#Shape of the stacked array holding ncomp quantities on the grid returned by readGrid
+def fieldsShape(grid,ncomp):
+    return (grid['nphi']+1,grid['nt'],len(grid['r']),ncomp)
@@ -0,0 +1,190 @@
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor,FIRST_COMPLETED,wait
+from concurrent.futures.process import BrokenProcessPool
+
+#Runs target(*args) inside a worker and turns whatever happens into an exit status, like the exitcode of an mp.Process
+#returns (status, message): 0 on success, the code of a SystemExit, or 1 with the traceback of any other exception
+def runTask(target,args):
+    try:
+        target(*args)
+        return 0,''
+    except SystemExit as e:
+        if e.code is None: return 0,''
+        if isinstance(e.code,int): return e.code,'SystemExit({:d})'.format(e.code)
+        return 1,str(e.code)
+    except BaseException:
+        return 1,traceback.format_exc()
+
+#Prints how a task ended, with the time elapsed since start
+def logResult(name,res,start,verbose):
+    if verbose and res[0] == 0: print('Task {:s} finished ({:.1f} s elapsed)'.format(name,time.time()-start))
+    elif verbose: print('Task {:s} failed with exit status {:d}:\n{:s}'.format(name,res[0],res[1]))
+
+#Takes task k back from a pool that broke while it was in flight. A worker that dies takes the whole pool with it, so
+#the first time this happens to a task it is put in suspects, to be rerun on its own in a fresh pool
+#returns the result of a task that was already rerun, and so is the one that breaks the pool, or None if it will be rerun
+def lostTask(k,suspects,retried):
+    if k in retried: return (-1,'worker process terminated abruptly')
+    retried.add(k)
+    suspects.append(k)
+    return None
+
+#Runs target(*args) for every args in arglist on a persistent pool of nproc worker processes
+#A new task is handed out as soon as a worker frees up, with at most maxinflight tasks submitted at any one time
+#(0 or None allows two per worker, so that no worker waits on the scheduler between tasks)
+#names labels each task in the report and defaults to its position in arglist
+#initializer(*initargs) is run once in every worker process as it starts
+#returns a list of (name, status, message) in the order of arglist, where a status of 0 means success
+def runTasks(target,arglist,nproc,maxinflight=None,names=None,verbose=True,initializer=None,initargs=()):
+    arglist = list(arglist)
+    if names is None: names = [str(k) for k in range(len(arglist))]
+    return runGraph([(names[k],target,arglist[k],[]) for k in range(len(arglist))],nproc,maxinflight,verbose,initializer,initargs)
+
+#Runs a graph of tasks on a persistent pool of nproc worker processes
+#tasks is a list of (name, target, args, dependencies), where dependencies lists the names of tasks that must succeed first
+#A task is submitted as soon as its dependencies have succeeded, earlier tasks in the list first, with at most maxinflight in flight
+#A task whose dependency failed is not run, and reports an exit status of -2
+#The tasks in flight when a worker dies are rerun one at a time in a fresh pool, and the one that kills a worker again fails
+#initializer(*initargs) is run once in every worker process as it starts
+#returns a list of (name, status, message) in the order of tasks
+def runGraph(tasks,nproc,maxinflight=None,verbose=True,initializer=None,initargs=()):
+    index = dict([(tasks[k][0],k) for k in range(len(tasks))])
+    waiting = [set(t[3]) for t in tasks]
+    for k in range(len(tasks)):
+        if not waiting[k] <= set(index.keys()): raise ValueError('Task {:s} depends on unknown tasks {:s}'.format(tasks[k][0],str(sorted(waiting[k]-set(index.keys())))))
+    dependents = [[] for t in tasks]
+    for k in range(len(tasks)):
+        for d in waiting[k]: dependents[index[d]].append(k)
+    if not maxinflight: maxinflight = 2*nproc
+    maxinflight = max(1,maxinflight)
+    results = [None for t in tasks]
+    ready = [k for k in range(len(tasks)) if len(waiting[k]) == 0]
+    start = time.time()
+    inflight = {}
+
+    #records the result of task k, releasing the tasks that depend on it or skipping them if it failed
+    def finish(k,res):
+        results[k] = (tasks[k][0],)+res
+        logResult(tasks[k][0],res,start,verbose)
+        for j in dependents[k]:
+            if not results[j] is None: continue
+            if res[0] == 0:
+                waiting[j].discard(tasks[k][0])
+                if len(waiting[j]) == 0: ready.append(j)
+            else: finish(j,(-2,'skipped because task {:s} failed'.format(tasks[k][0])))
+
+    suspects = []
+    retried = set()
+    pool = ProcessPoolExecutor(max_workers=max(1,nproc),initializer=initializer,initargs=initargs)
+    try:
+        while len(ready) > 0 or len(inflight) > 0 or len(suspects) > 0:
+            if len(suspects) > 0:
+                if len(inflight) == 0:
+                    k = suspects.pop(0)
+                    inflight[pool.submit(runTask,tasks[k][1],tasks[k][2])] = k
+            else:
+                ready.sort()
+                while len(ready) > 0 and len(inflight) < maxinflight:
+                    k = ready.pop(0)
+                    inflight[pool.submit(runTask,tasks[k][1],tasks[k][2])] = k
+            done,pending = wait(list(inflight.keys()),return_when=FIRST_COMPLETED)
+            broken = False
+            for f in done:
+                k = inflight.pop(f)
+                try: res = f.result()
+                except BrokenProcessPool:
+                    res = lostTask(k,suspects,retried)
+                    broken = True
+                if not res is None: finish(k,res)
+            #a fresh pool takes over from a broken one, and the tasks that were still in flight are rerun
+            if broken:
+                for f in list(inflight.keys()):
+                    k = inflight.pop(f)
+                    res = lostTask(k,suspects,retried)
+                    if not res is None: finish(k,res)
+                suspects.sort()
+                pool.shutdown(wait=False,cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=max(1,nproc),initializer=initializer,initargs=initargs)
+    finally: pool.shutdown(wait=True,cancel_futures=True)
+    for k in range(len(tasks)):
+        if results[k] is None: results[k] = (tasks[k][0],-2,'never became ready')
+    return results
+
+#Runs target(*args) for every (name, args) drawn from tasks on a persistent pool of nproc worker processes
+#tasks can be any iterable, such as a generator that builds the arguments of each task as it goes, and is only advanced
+#when fewer than maxinflight tasks are in flight, so no more than that many sets of arguments are held at once
+#If drawing a task from tasks raises, that is reported as a failed task and no more are drawn
+#The tasks in flight when a worker dies are rerun one at a time in a fresh pool, and the one that kills a worker again fails
+#returns a list of (name, status, message) in the order of tasks
+def runStream(target,tasks,nproc,maxinflight=None,verbose=True,initializer=None,initargs=()):
+    if not maxinflight: maxinflight = 2*nproc
+    maxinflight = max(1,maxinflight)
+    tasks = iter(tasks)
+    names = []
+    results = []
+    start = time.time()
+    inflight = {}
+    arglist = []
+    exhausted = False
+    suspects = []
+    retried = set()
+
+    #records the result of task k, dropping its arguments
+    def finish(k,res):
+        results[k] = (names[k],)+res
+        arglist[k] = None
+        logResult(names[k],res,start,verbose)
+
+    pool = ProcessPoolExecutor(max_workers=max(1,nproc),initializer=initializer,initargs=initargs)
+    try:
+        while not exhausted or len(inflight) > 0 or len(suspects) > 0:
+            if len(suspects) > 0:
+                if len(inflight) == 0:
+                    k = suspects.pop(0)
+                    inflight[pool.submit(runTask,target,arglist[k])] = k
+            while len(suspects) == 0 and not exhausted and len(inflight) < maxinflight:
+                try: name,args = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                except BaseException:
+                    exhausted = True
+                    names.append('task stream')
+                    results.append(None)
+                    arglist.append(None)
+                    finish(len(names)-1,(1,traceback.format_exc()))
+                    break
+                names.append(name)
+                results.append(None)
+                arglist.append(args)
+                inflight[pool.submit(runTask,target,args)] = len(names)-1
+            if len(inflight) == 0: continue
+            done,pending = wait(list(inflight.keys()),return_when=FIRST_COMPLETED)
+            broken = False
+            for f in done:
+                k = inflight.pop(f)
+                try: res = f.result()
+                except BrokenProcessPool:
+                    res = lostTask(k,suspects,retried)
+                    broken = True
+                if not res is None: finish(k,res)
+            if broken:
+                for f in list(inflight.keys()):
+                    k = inflight.pop(f)
+                    res = lostTask(k,suspects,retried)
+                    if not res is None: finish(k,res)
+                suspects.sort()
+                pool.shutdown(wait=False,cancel_futures=True)
+                pool = ProcessPoolExecutor(max_workers=max(1,nproc),initializer=initializer,initargs=initargs)
+    finally: pool.shutdown(wait=True,cancel_futures=True)
+    return results
+
+#Prints one line per failed task and returns the number of failures
+def reportTasks(results):
+    failed = [res for res in results if not res[1] == 0]
+    if len(failed) == 0: print('All jobs completed.')
+    else:
+        print('All jobs completed, {:d} of {:d} failed:'.format(len(failed),len(results)))
+        for res in failed: print('  task {:s}: exit status {:d}'.format(res[0],res[1]))
+    return len(failed)
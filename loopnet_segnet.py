@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as nnf
+from loopnet_features import computeCurvature
 
 #Channels are r, |latitude|, Dlongitude, Dr_cyl, D|z|, |Br|, Bh, vr, S-<S>, log(beta), and k
 #Initial length is 400
@@ -41,13 +42,16 @@ class WNet(nn.Module):
         self.drop = nn.Dropout(p=dropout)
         self.smax = nn.Softmax(dim=1)
 
-    def forward(self, x, ret = 'enc'): #not specifying ret will return only the encoded outputs. changing it (nominally to 'dec') will return the recreated image
+    def encode(self, x): #class probabilities of each point, the output of the encoder
         ex1d = nnf.relu(self.econv1b(self.econv1a(self.drop(x))))
         ex2d = nnf.relu(self.econv2b(self.econv2a(self.drop(self.pool(ex1d)))))
         ex3 = nnf.relu(self.econv3b(self.econv3a(self.drop(self.pool(ex2d)))))
         ex2u = nnf.relu(self.econv2d(self.econv2c(self.drop(torch.cat((self.etconv3(ex3),ex2d),1)))))
         ex1u = nnf.relu(self.econv1e(self.econv1d(self.econv1c(self.drop(torch.cat((self.etconv2(ex2u),ex1d),1))))))
-        exfinal = self.smax(ex1u)
+        return self.smax(ex1u)
+
+    def forward(self, x, ret = 'enc'): #not specifying ret will return only the encoded outputs. changing it (nominally to 'dec') will return the recreated image
+        exfinal = self.encode(x)
         if ret == 'enc': return exfinal
         else:
             dx1d = nnf.relu(self.dconv1b(self.dconv1a(self.drop(exfinal))))
@@ -57,6 +61,17 @@ class WNet(nn.Module):
             dx1u = nnf.relu(self.dconv1e(self.dconv1d(self.dconv1c(self.drop(torch.cat((self.dtconv2(dx2u),dx1d),1))))))
             return dx1u
 
+#The encoder half of a trained WNet, sharing its layers, for inference where only the segmentation is needed
+#the decoder layers are left out, so they are neither traced nor saved when the encoder is exported
+class WNetEncoder(nn.Module):
+    def __init__(self,wnet):
+        super(WNetEncoder, self).__init__()
+        for name in ['econv1a','econv1b','econv2a','econv2b','econv3a','econv3b','etconv3','econv2c','econv2d','etconv2','econv1c','econv1d','econv1e','pool','drop','smax']:
+            setattr(self,name,getattr(wnet,name))
+
+    def forward(self, x):
+        return WNet.encode(self,x)
+
 def JsoftNcut(pix, K, weights):
     nbatch = pix.size()[0]
     nclass = pix.size()[1]
@@ -84,23 +99,6 @@ def delta(x):
     dx[1:] = x[1:]-x[:-1]
     return dx
 
-def computeCurvature(rs): #assumes rs has shape nlines x 3 x nds+1
-    dp = np.append(rs[:,0,1:] - rs[:,0,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    dt = np.append(rs[:,1,1:] - rs[:,1,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    dr = np.append(rs[:,2,1:] - rs[:,2,:-1],np.zeros((len(rs[:,0,0]),1)),axis=1)
-    Tr = dr
-    Tt = dt*rs[:,2,:]
-    Tp = dp*rs[:,2,:]*np.sin(rs[:,1,:]) 
-    ds = np.sqrt(Tr**2+Tt**2+Tp**2)
-    ds[np.where(ds == 0)] = np.max(ds)
-    dTr = np.append(np.zeros((len(rs[:,0,0]),1)),Tr[:,1:]-Tr[:,:-1],axis=1)
-    dTt = np.append(np.zeros((len(rs[:,0,0]),1)),Tt[:,1:]-Tt[:,:-1],axis=1)
-    dTp = np.append(np.zeros((len(rs[:,0,0]),1)),Tp[:,1:]-Tp[:,:-1],axis=1)
-    curvature = np.sqrt(dTr**2+dTt**2+dTp**2)/ds**2
-    curvature[np.where(np.isnan(curvature))] = 0
-    curvature = np.cbrt(curvature) * np.sign(dTr)
-    return curvature
-
 #Data compiled have shape nlines x nchannels x npoints       #exclude = [0,1,2,5,9]
 def compileData(file_list,exclude = None,normalize = True,loops = None,verbose = False):
     data = None
@@ -0,0 +1,21 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+#Allocates an array in shared memory so that worker processes can read it without receiving a copy
+#returns the array, the SharedMemory block backing it, and a small picklable spec for attachShared
+def createShared(shape,dtype=np.float64):
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True,size=max(1,int(np.prod(shape))*dtype.itemsize))
+    arr = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    return arr,shm,(shm.name,tuple(shape),dtype.str)
+
+#Attaches to an array made by createShared in another process, returning the array and its SharedMemory block
+def attachShared(spec):
+    shm = shared_memory.SharedMemory(name=spec[0])
+    return np.ndarray(spec[1],dtype=np.dtype(spec[2]),buffer=shm.buf),shm
+
+#Detaches from a shared block, and frees it if this process created it
+#any arrays viewing the block must have been deleted first
+def releaseShared(shm,unlink=False):
+    shm.close()
+    if unlink: shm.unlink()
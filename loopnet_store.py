@@ -0,0 +1,144 @@
+import numpy as np
+import zipfile
+import struct
+import os
+
+#Pickle-free storage for merged loop structures, the (centerline, girth) tuples written by find_loops
+#A store is an uncompressed .npz holding
+#  coords: the centerlines of every structure side by side, with shape 3 x total points
+#  girth: the girths of every structure one after another
+#  offsets: where each structure starts in coords and girth, with one more entry marking the end of the last
+#  snapshots: where each snapshot starts in offsets, with one more entry marking the end of the last
+#  numbers: the file number of each snapshot
+#so any number of snapshots can share one file. The members are memory-mapped rather than read, and structures are
+#only copied out of the file when they are accessed
+
+#open stores, keyed by path, with the modification time and inode of the file they were opened from, so that a packed
+#store is mapped only once per process but a store rewritten since, by this process or any other, is opened again
+_stores = {}
+
+#Writes snapshots, a list of lists of (centerline, girth) tuples, with the file numbers in numbers to a store at fname
+def writeStructures(fname,snapshots,numbers,dtype=np.float64):
+    structs = [st for snap in snapshots for st in snap]
+    lengths = np.array([np.shape(st[1])[0] for st in structs],dtype=np.int64)
+    offsets = np.zeros(len(structs)+1,dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    coords = np.zeros((3,offsets[-1]),dtype=dtype)
+    girth = np.zeros(offsets[-1],dtype=dtype)
+    for k in range(len(structs)):
+        coords[:,offsets[k]:offsets[k+1]] = structs[k][0]
+        girth[offsets[k]:offsets[k+1]] = structs[k][1]
+    snaps = np.zeros(len(snapshots)+1,dtype=np.int64)
+    snaps[1:] = np.cumsum([len(snap) for snap in snapshots])
+    #the new store replaces any old one only once it is complete, so readers that have the old one mapped keep a whole file
+    _stores.pop(os.path.abspath(fname),None)
+    np.savez(fname+'.tmp.npz',coords=coords,girth=girth,offsets=offsets,snapshots=snaps,numbers=np.array([int(n) for n in numbers],dtype=np.int64))
+    os.replace(fname+'.tmp.npz',fname)
+
+#Memory-maps the member name of the uncompressed zip file zf, opened from path
+def mapMember(path,zf,name):
+    info = zf.getinfo(name)
+    if not info.compress_type == zipfile.ZIP_STORED: raise ValueError('Member {:s} of {:s} is compressed and cannot be mapped'.format(name,path))
+    with open(path,'rb') as f:
+        f.seek(info.header_offset)
+        nlen,xlen = struct.unpack('<HH',f.read(30)[26:30])
+        f.seek(info.header_offset+30+nlen+xlen)
+        version = np.lib.format.read_magic(f)
+        if version == (1,0): shape,fortran,dtype = np.lib.format.read_array_header_1_0(f)
+        else: shape,fortran,dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if int(np.prod(shape)) == 0: return np.zeros(shape,dtype=dtype)
+    return np.memmap(path,dtype=dtype,mode='r',shape=shape,order='F' if fortran else 'C',offset=offset)
+
+#A store written by writeStructures, with its arrays memory-mapped
+class StructureStore:
+    def __init__(self,fname):
+        self.fname = fname
+        with zipfile.ZipFile(fname) as zf:
+            for name in ['coords','girth','offsets','snapshots','numbers']: setattr(self,name,mapMember(fname,zf,name+'.npy'))
+        self.index = dict([(int(self.numbers[k]),k) for k in range(len(self.numbers))])
+
+    #The structures of the snapshot with file number fnum
+    def snapshot(self,fnum):
+        k = self.index[int(fnum)]
+        return StructureList(self,self.snapshots[k],self.snapshots[k+1])
+
+#The structures of one snapshot of a store, read lazily
+#Indexing gives a (centerline, girth) tuple of float64 copies, laid out as find_loops made them, so they can be changed freely
+class StructureList:
+    def __init__(self,store,first,last):
+        self.store = store
+        self.first = int(first)
+        self.last = int(last)
+
+    def __len__(self):
+        return self.last-self.first
+
+    def __getitem__(self,k):
+        if isinstance(k,slice): return [self[j] for j in range(*k.indices(len(self)))]
+        if k < 0: k += len(self)
+        if k < 0 or k >= len(self): raise IndexError('structure index {:d} out of range'.format(k))
+        a,b = self.store.offsets[self.first+k],self.store.offsets[self.first+k+1]
+        return np.array(self.store.coords[:,a:b],dtype=np.float64),np.array(self.store.girth[a:b],dtype=np.float64)
+
+    def __iter__(self):
+        for k in range(len(self)): yield self[k]
+
+#Opens the store at fname, reusing it if this process has already opened the same file
+def openStore(fname):
+    key = os.path.abspath(fname)
+    stat = os.stat(fname)
+    version = (stat.st_mtime_ns,stat.st_ino)
+    if not key in _stores or not _stores[key][0] == version: _stores[key] = (version,StructureStore(fname))
+    return _stores[key][1]
+
+#Path of the store holding the structures of file number fname alone, and of one packing several snapshots together
+def storePath(dirstruct,fname_pref,fname):
+    return '{:s}{:s}_f{:s}.npz'.format(dirstruct,fname_pref,fname)
+
+def packedPath(dirstruct,fname_pref):
+    return '{:s}{:s}.npz'.format(dirstruct,fname_pref)
+
+#Path of the object array holding the structures of file number fname, as saved with LOOP_STRUCTURES_FORMAT 'npy'
+def arrayPath(dirstruct,fname_pref,fname):
+    return '{:s}{:s}_f{:s}.npy'.format(dirstruct,fname_pref,fname)
+
+#Returns the merged structures of file number fname from whichever was written last of its own store, a packed store
+#holding it, or the object array saved with LOOP_STRUCTURES_FORMAT 'npy' or by older versions of find_loops
+#files written at the same time are preferred in that order
+def loadStructures(dirstruct,fname_pref,fname):
+    found = []
+    if os.path.exists(arrayPath(dirstruct,fname_pref,fname)): found.append((os.stat(arrayPath(dirstruct,fname_pref,fname)).st_mtime_ns,0,'array'))
+    if os.path.exists(packedPath(dirstruct,fname_pref)) and int(fname) in openStore(packedPath(dirstruct,fname_pref)).index:
+        found.append((os.stat(packedPath(dirstruct,fname_pref)).st_mtime_ns,1,'packed'))
+    if os.path.exists(storePath(dirstruct,fname_pref,fname)): found.append((os.stat(storePath(dirstruct,fname_pref,fname)).st_mtime_ns,2,'store'))
+    kind = max(found)[2] if len(found) > 0 else 'array'
+    if kind == 'store': return openStore(storePath(dirstruct,fname_pref,fname)).snapshot(fname)
+    if kind == 'packed': return openStore(packedPath(dirstruct,fname_pref)).snapshot(fname)
+    return np.load(arrayPath(dirstruct,fname_pref,fname),allow_pickle=True)
+
+#Saves the merged structures of file number fname in the format named by LOOP_STRUCTURES_FORMAT, removing any file of
+#the other format saved for it before
+def saveStructures(dirstruct,fname_pref,fname,merged_structures,config):
+    if config['LOOP_STRUCTURES_FORMAT'] == 'store':
+        writeStructures(storePath(dirstruct,fname_pref,fname),[merged_structures],[fname],config['LOOP_STRUCTURES_STORE_DTYPE'])
+        if os.path.exists(arrayPath(dirstruct,fname_pref,fname)): os.remove(arrayPath(dirstruct,fname_pref,fname))
+    else:
+        arr = np.empty(len(merged_structures),dtype=object)
+        for k in range(len(merged_structures)): arr[k] = merged_structures[k]
+        np.save(arrayPath(dirstruct,fname_pref,fname),arr)
+        if os.path.exists(storePath(dirstruct,fname_pref,fname)):
+            _stores.pop(os.path.abspath(storePath(dirstruct,fname_pref,fname)),None)
+            os.remove(storePath(dirstruct,fname_pref,fname))
+
+#Converts the structures of the file numbers in file_list, in whatever format they were saved, to stores
+#packed puts them all in one store instead of one per file
+#returns the list of stores written
+def convertStructures(dirstruct,fname_pref,file_list,packed=False,dtype=np.float64,verbose=False):
+    snapshots = [list(loadStructures(dirstruct,fname_pref,fname)) for fname in file_list]
+    if packed: written = [(packedPath(dirstruct,fname_pref),snapshots,file_list)]
+    else: written = [(storePath(dirstruct,fname_pref,file_list[k]),[snapshots[k]],[file_list[k]]) for k in range(len(file_list))]
+    for fname,snaps,numbers in written:
+        writeStructures(fname,snaps,numbers,dtype)
+        if verbose: print('Wrote {:d} structures from {:d} files to {:s}'.format(int(np.sum([len(snap) for snap in snaps])),len(snaps),fname))
+    return [w[0] for w in written]
@@ -4,8 +4,15 @@ import matplotlib.pyplot as plt
 import numpy as np
 from cmd_util import *
 import sys
+import os
 from scipy.interpolate import RegularGridInterpolator as rgi
+from scipy.spatial import cKDTree
+from scipy.optimize import linprog
+from scipy.sparse import csr_matrix
 import multiprocessing as mp
+import loopnet_rayleigh as lr
+import loopnet_overlap as lo
+import loopnet_store as lst
 
 #Converts a 3xN array of phi,theta,r values to a 3xN array of x,y,z values 
 def sphToCart(a):
@@ -26,30 +33,20 @@ def checkOverlap(a,b,tolerance,threshold,verbose=False):
     if Nb*0.5 > Na: 
         if verbose: print('Size difference between lines too large. len b / a = ',Nb/Na)
         return False
-    for k in range(Nb+Na-2*Nmin):
-        al = np.max([0,Na-1-Nmin-k])
-        ar = np.min([Na-1,Na+Nb-2-Nmin-k])
-        bl = np.max([0,Nmin+k-Na+1])
-        br = np.min([Nb-1,Nmin+k])
-        N1 = len(np.where(np.sqrt(np.sum((a[:,al:ar+1]-b[:,bl:br+1])**2,axis=0))<=tolerance)[0])
-        if verbose: print('Match fraction is {:.2f}'.format(N1/Na))  
-        if N1 >= Nmin: return True
-    return False
+    counts = lo.shiftCounts(a,b,Nmin,tolerance)
+    match = np.where(counts >= Nmin)[0]
+    if verbose:
+        for N1 in counts[:(match[0]+1 if len(match) > 0 else len(counts))]: print('Match fraction is {:.2f}'.format(N1/Na))
+    return len(match) > 0
 
 def scoreOverlap(a,b):
     N = np.min([np.shape(a)[1],np.shape(b)[1]])
     Nmin = int(np.floor(N*0.5)) #make sure to consider only configurations involving at least half of the nodes on the smaller line, to avoid bad statistics
-    scores = np.ones(len(b[0,:])+len(a[0,:])-2*Nmin)
     if np.shape(a)[1] > N:
         c = b
         b = a
         a = c
-    for k in range(len(b[0,:])+N-2*Nmin):
-        al = np.max([0,N-1-Nmin-k])
-        ar = np.min([N-1,N+len(b[0,:])-2-Nmin-k])
-        bl = np.max([0,Nmin+k-N+1])
-        br = np.min([len(b[0,:])-1,Nmin+k])
-        scores[k] = np.mean(np.sqrt(np.sum((a[:,al:ar+1]-b[:,bl:br+1])**2,axis=0))) #score is average distance between two line segments in this configuration
+    scores = lo.shiftMeans(a,b,Nmin) #score is average distance between two line segments in each configuration
     return np.min(scores) #return the score of the closest configuration
         
 
@@ -58,20 +55,31 @@ def averageLines(structure,lines):
     for k in structure: avgxyz += sphToCart(lines[k,:3,:])
     return avgxyz/len(structure)
 
+#Advects the centerlines in lines (a list of 3xN phi,theta,r arrays) by the mean differential rotation over a time dt
+#fnp interpolates the angular velocity on (theta, r), and every point of every line is looked up in one call, clipped to
+#the grid so that points just outside it take the rotation of the nearest boundary
+#The drift is purely azimuthal, so theta and r never change and the angular velocity of a point is the same at every
+#sub-step: ndt sub-steps of dt/ndt move it exactly as far as one step of dt, and are only kept for compatibility
+#returns the drifted lines, with phi wrapped into [0, 2pi)
+def driftLines(lines,fnp,dt,ndt=1):
+    if len(lines) == 0: return []
+    lengths = [np.shape(line)[1] for line in lines]
+    pts = np.concatenate(lines,axis=1)
+    lo = [fnp.grid[0][0],fnp.grid[1][0]]
+    hi = [fnp.grid[0][-1],fnp.grid[1][-1]]
+    omega = fnp(np.clip(pts[1:3,:].T,lo,hi))
+    drifted = pts.copy()
+    drifted[0,:] = np.mod(pts[0,:]+omega*dt,2*np.pi)
+    return np.split(drifted,np.cumsum(lengths)[:-1],axis=1)
+
 def driftLine(line,fnp,dt,ndt=1):
-    drifts = np.zeros_like(line)
-    for k in range(len(line[0,:])):
-        for j in range(ndt):
-            try:
-                drifts[0,k] = drifts[0,k] + fnp([drifts[1,k]+line[1,k],drifts[2,k]+line[2,k]])*dt/ndt
-    return line #+ drifts
-
-def reduceMatches(matches,loop,next_loops,maxmatch,fnp,Dt):
+    return driftLines([line],fnp,dt,ndt)[0]
+
+#Keeps the maxmatch matches whose cartesian centerlines in nextxyz lie closest to the drifted centerline thisxyz (scoreOverlap)
+def reduceMatches(matches,thisxyz,nextxyz,maxmatch):
     scores = np.zeros(len(matches))
-    thisxyz = sphToCart(driftLine(loop[:3,:],fnp,Dt))
     for k in range(len(scores)):
-        nextxyz = sphToCart(next_loops[k][:3,:])
-        scores[k] = scoreOverlap(thisxyz,nextxyz)
+        scores[k] = scoreOverlap(thisxyz,nextxyz[k])
     sortidx = np.argsort(scores)
     matches_out = []
     for k in range(maxmatch):
@@ -79,12 +87,77 @@ def reduceMatches(matches,loop,next_loops,maxmatch,fnp,Dt):
     return matches_out
         
 
-def worker(fname,config):
-    fname_pref = config['LOOP_STRUCTURES_PREFIX']
-    datadir = config['LOOP_STRUCTURES_PATH']
+#Spatial index of a list of 3xN cartesian centerlines: a KD-tree over all their points, the centerline each point
+#belongs to, and the length of each centerline. None if there are no centerlines
+def indexStructures(xyz):
+    if len(xyz) == 0: return None
+    lengths = np.array([np.shape(x)[1] for x in xyz])
+    return cKDTree(np.concatenate(xyz,axis=1).T),np.repeat(np.arange(len(xyz)),lengths),lengths
+
+#Pairs every drifted structure in thisxyz with the structures in nextxyz (lists of 3xN cartesian centerlines) it overlaps (checkOverlap)
+#A KD-tree over all points of nextxyz (index, from indexStructures if it has already been built) limits checkOverlap to the
+#structures with a point within tolerance of the current one, unless the overlap threshold rounds down to zero points, in
+#which case any pair can match
+#returns a list with the indices of the matching next structures for each current structure, in increasing order
+def pairStructures(thisxyz,nextxyz,tolerance,threshold,index=None):
+    matches = [[] for x in thisxyz]
+    if len(nextxyz) == 0: return matches
+    if index is None: index = indexStructures(nextxyz)
+    tree,owner,lengths = index
+    for s1 in range(len(thisxyz)):
+        near = tree.query_ball_point(thisxyz[s1].T,tolerance*(1+1e-9))
+        near = owner[np.concatenate([np.zeros(0,dtype=int)]+[np.array(n,dtype=int) for n in near])]
+        wild = np.where(np.floor(np.minimum(lengths,np.shape(thisxyz[s1])[1])*threshold) == 0)[0]
+        for s2 in np.unique(np.append(near,wild)):
+            if checkOverlap(thisxyz[s1],nextxyz[s2],tolerance,threshold): matches[s1].append(int(s2))
+    return matches
+
+#Returns theta, r and the azimuthal mean of v_phi (nt x nr) of file number fname
+#The mean is streamed from the 3D output the first time and kept in a small sidecar file in LOOP_TRACKING_PATH,
+#which is all that later calls read
+def rotationProfile(config,fname):
+    path = '{:s}{:s}_f{:s}.npz'.format(config['LOOP_TRACKING_PATH'],config['LOOP_TRACKING_PROFILE_PREFIX'],fname)
+    if os.path.exists(path):
+        with np.load(path) as f: return f['theta'],f['r'],f['vphi']
+    dir3d = config['SPHERICAL_DATA_PATH']
+    grid = lr.readGrid(dir3d,fname)
+    vphi = lr.meanField(dir3d,fname,'0003',grid)
+    np.savez(path+'.tmp.npz',theta=grid['theta'],r=grid['r'],vphi=vphi)
+    os.replace(path+'.tmp.npz',path)
+    return grid['theta'],grid['r'],vphi
+
+#Loads the merged structures of file number fname, with their cartesian centerlines and the spatial index used when
+#they are paired onto from the previous snapshot
+def loadSnapshot(config,fname):
+    structs = lst.loadStructures(config['LOOP_STRUCTURES_PATH'],config['LOOP_STRUCTURES_PREFIX'],fname)
+    lines = [st[0] for st in structs]
+    xyz = [sphToCart(line) for line in lines]
+    return {'lines':lines,'xyz':xyz,'index':indexStructures(xyz)}
+
+#Streams the snapshots of file_list in time order, yielding the name and arguments of matchSnapshots for every
+#consecutive pair. Each snapshot is loaded and indexed once, and only the current and next ones are held at a time
+#A snapshot that cannot be loaded here is left for the worker to load, so that its error is reported by the pairs that need it
+def pairTasks(file_list,config):
+    if len(file_list) < 2: return
+    empty = {'lines':None,'xyz':None,'index':None}
+    try: nxt = loadSnapshot(config,file_list[0])
+    except Exception: nxt = empty
+    for k in range(len(file_list)-1):
+        this = nxt
+        try: nxt = loadSnapshot(config,file_list[k+1])
+        except Exception: nxt = empty
+        yield '{:s}_to_{:s}'.format(file_list[k],file_list[k+1]),([file_list[k],file_list[k+1]],this['lines'],nxt['xyz'],nxt['index'],config)
+
+#Pairs the structures of file numbers fname[0] and fname[1], given the centerlines of the first and the cartesian
+#centerlines and spatial index of the second, and saves the matches
+#lines or nextxyz of None loads that snapshot here instead
+def matchSnapshots(fname,lines,nextxyz,index,config):
+    if lines is None: lines = loadSnapshot(config,fname[0])['lines']
+    if nextxyz is None:
+        nxt = loadSnapshot(config,fname[1])
+        nextxyz,index = nxt['xyz'],nxt['index']
     track_pref = config['LOOP_TRACKING_PREFIX']
     trackdir = config['LOOP_TRACKING_PATH']
-    dir3d = config['SPHERICAL_DATA_PATH']
     rstar = config['STELLAR_RADIUS']
     tolerance = config['LOOP_TRACKING_RADIUS_TOLERANCE']
     threshold = config['LOOP_TRACKING_PROXIMITY_THRESHOLD']
@@ -93,57 +166,107 @@ def worker(fname,config):
     verbose = config['VERBOSE']
     
     if verbose: print('Working on files {:s} and {:s}...'.format(fname[0],fname[1]))
-    f = open('{:s}{:s}_grid'.format(dir3d,fname[0]),'rb')
-    skipbyte = np.fromfile(f,count=1,dtype=np.int32)
-    nr = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nt = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    nphi = int(np.fromfile(f,count=1,dtype=np.int32))
-    skipbyte = np.fromfile(f,count=2,dtype=np.int32)
-    r = np.fromfile(f,count=nr,dtype=np.float64)[::-1]
-    try: 
-        overlap_ind = np.where(r[1:]==r[:-1])[0][0]
-        r = np.append(r[:overlap_ind],r[overlap_ind+1:])
-    except IndexError: overlap_ind = None
-    skipbyte = np.fromfile(f,count=1,dtype=np.float64)
-    theta = np.fromfile(f,count=nt,dtype=np.float64)[::-1]
-    phi = np.linspace(0,2*np.pi,nphi+1)
-    f.close()
-    nB = nr*nt*nphi
-
-    f = open('{:s}{:s}_0003'.format(dir3d,fname[0]),'rb')
-    vp = np.fromfile(f,count=nB,dtype=np.float64).reshape(nphi,nt,nr,order='F')[:,::-1,::-1]
-    if not overlap_ind is None: vp = np.append(vp[:,:,:overlap_ind],vp[:,:,overlap_ind+1:],axis=2)
-    vp = np.append(vp,np.expand_dims(vp[0,:,:],axis=0),axis=0)
-    f.close()
-
-    fnp = rgi((theta,r,),np.mean(vp,axis=0)*2*np.pi/r.reshape(1,len(r))/np.sin(theta.reshape(len(theta),1))) 
-    Dt = dt*(int(fname[1])-int(fname[0]))
+    theta,r,vp = rotationProfile(config,fname[0])
 
-    merged_structures = np.load('{:s}{:s}_f{:s}.npy'.format(datadir,fname_pref,fname[0]),allow_pickle=True)
-    next_merged_structures = np.load('{:s}{:s}_f{:s}.npy'.format(datadir,fname_pref,fname[1]),allow_pickle=True)
+    fnp = rgi((theta,r,),vp/r.reshape(1,len(r))/np.sin(theta.reshape(len(theta),1))) #angular velocity in radians per unit time
+    Dt = dt*(int(fname[1])-int(fname[0]))
 
     if verbose: print('Trying to pair structures')
 
-    matches = []
-    for s1 in range(len(merged_structures)):
-        matches.append([])
-        thisxyz = sphToCart(driftLine(merged_structures[s1][0],fnp,Dt))
-        for s2 in range(len(next_merged_structures)):
-            nextxyz = sphToCart(next_merged_structures[s2][0])
-            if checkOverlap(thisxyz,nextxyz,rstar*tolerance,threshold):
-                matches[s1].append(s2)
-    for k in range(len(merged_structures)):
+    thisxyz = [sphToCart(line) for line in driftLines(lines,fnp,Dt)]
+    matches = pairStructures(thisxyz,nextxyz,rstar*tolerance,threshold,index)
+    if config['LOOP_TRACKING_MODE'] == 'flow':
+        saveCandidates(fname,matches,thisxyz,nextxyz,config)
+        if verbose: print('Saved {:d} candidate links from files {:s} to {:s}'.format(int(np.sum([len(m) for m in matches])),fname[0],fname[1]))
+        return
+    for k in range(len(lines)):
         if len(matches[k]) == 0 and verbose: print('Found no matches for structure {:d} in next structures'.format(k))
         else: 
             if verbose: print('Structure {:d} was found to match onto next structures {:s}'.format(k,str(matches[k])[1:-1]))
             if len(matches[k]) > maxmatch:  #xxx rework this so that it takes into account how many times the target has been matched too, not just how many the origin has
-                matches[k] = reduceMatches(matches[k],merged_structures[k][0],[next_merged_structures[m][0] for m in matches[k]],maxmatch,fnp,Dt)
+                matches[k] = reduceMatches(matches[k],thisxyz[k],[nextxyz[m] for m in matches[k]],maxmatch)
                 if verbose: print('  Too many matches: reduced to structures {:s}'.format(str(matches[k])[1:-1]))
 
-    np.save('{:s}{:s}_f{:s}_to_{:s}'.format(track_dir,track_pref,fname[0],fname[1]),matches)
+    pairs = np.empty(len(matches),dtype=object)
+    for k in range(len(matches)): pairs[k] = matches[k]
+    np.save('{:s}{:s}_f{:s}_to_{:s}'.format(trackdir,track_pref,fname[0],fname[1]),pairs)
     if verbose: print('Finished work on files {:s} and {:s}'.format(fname[0],fname[1]))
-        
 
+#Path of the candidate links from file number fname[0] to fname[1] saved in flow mode
+def candidatePath(config,fname):
+    return '{:s}{:s}_f{:s}_to_{:s}_candidates.npz'.format(config['LOOP_TRACKING_PATH'],config['LOOP_TRACKING_PREFIX'],fname[0],fname[1])
 
+#Saves every match as a candidate link for trackFlow, costing the mean distance between the matched centerlines
+#(scoreOverlap) in units of the tolerance radius. A structure keeps at most LOOP_TRACKING_MAX_MATCH of its cheapest links
+def saveCandidates(fname,matches,thisxyz,nextxyz,config):
+    scale = config['STELLAR_RADIUS']*config['LOOP_TRACKING_RADIUS_TOLERANCE']
+    src = []
+    dst = []
+    cost = []
+    for k in range(len(matches)):
+        costs = np.array([scoreOverlap(thisxyz[k],nextxyz[m]) for m in matches[k]])/scale
+        keep = np.sort(np.argsort(costs)[:config['LOOP_TRACKING_MAX_MATCH']])
+        src += [k]*len(keep)
+        dst += [matches[k][j] for j in keep]
+        cost += list(costs[keep])
+    np.savez(candidatePath(config,fname),src=np.array(src,dtype=np.int64),dst=np.array(dst,dtype=np.int64),cost=np.array(cost,dtype=np.float64),
+             shape=np.array([len(thisxyz),len(nextxyz)],dtype=np.int64))
+
+#Chooses the links between the structures of consecutive files in file_list with a single min-cost flow over the whole
+#sequence, from the candidates saved by the pair workers in flow mode, and saves them as the usual pairing files
+#Every structure lies on at least one trajectory. A trajectory is born or dies at a cost of LOOP_TRACKING_BIRTH_COST or
+#LOOP_TRACKING_DEATH_COST, follows a candidate link at the cost of that link, and a structure may pass on more trajectories
+#than reach it (a split) at LOOP_TRACKING_SPLIT_COST each, or end more than it passes on (a merge) at LOOP_TRACKING_MERGE_COST each
+#Each structure is a node pair in -> out, joined by an edge carrying at least one unit, so that the constraints form a
+#network matrix and the simplex solution is integral
+#returns the number of links kept and the numbers of births, deaths, splits and merges
+def trackFlow(file_list,config):
+    verbose = config['VERBOSE']
+    pairs = [[file_list[k],file_list[k+1]] for k in range(len(file_list)-1)]
+    cands = []
+    for pair in pairs:
+        with np.load(candidatePath(config,pair)) as f: cands.append(dict([(key,f[key]) for key in ['src','dst','cost','shape']]))
+    if len(cands) == 0: return {}
+    counts = [int(c['shape'][0]) for c in cands]+[int(cands[-1]['shape'][1])]
+    offsets = np.append(0,np.cumsum(counts))
+    N = int(offsets[-1])
+    src = np.concatenate([c['src']+offsets[k] for k,c in enumerate(cands)])
+    dst = np.concatenate([c['dst']+offsets[k+1] for k,c in enumerate(cands)])
+    nodes = np.arange(N)
+    S,T = 2*N,2*N+1
+
+    #edges as (tail, head, cost, lower bound, upper bound), in the order links, through, birth, death, split, merge, return
+    tail = np.concatenate([2*src+1,2*nodes,np.full(N,S),2*nodes+1,np.full(N,S),2*nodes,[T]])
+    head = np.concatenate([2*dst,2*nodes+1,2*nodes,np.full(N,T),2*nodes+1,np.full(N,T),[S]])
+    cost = np.concatenate([np.concatenate([c['cost'] for c in cands]),np.zeros(N),np.full(N,config['LOOP_TRACKING_BIRTH_COST']),np.full(N,config['LOOP_TRACKING_DEATH_COST']),
+                           np.full(N,config['LOOP_TRACKING_SPLIT_COST']),np.full(N,config['LOOP_TRACKING_MERGE_COST']),[0]])
+    nlink = len(src)
+    lower = np.zeros(len(tail))
+    lower[nlink:nlink+N] = 1
+    upper = np.full(len(tail),np.inf)
+    upper[:nlink] = 1
+    edges = np.arange(len(tail))
+    A = csr_matrix((np.concatenate([np.ones(len(tail)),-np.ones(len(tail))]),(np.concatenate([head,tail]),np.concatenate([edges,edges]))),shape=(2*N+2,len(tail)))
+    if verbose: print('Solving a flow over {:d} structures in {:d} files with {:d} candidate links'.format(N,len(file_list),nlink))
+    res = linprog(cost,A_eq=A,b_eq=np.zeros(2*N+2),bounds=np.column_stack([lower,upper]),method='highs-ds')
+    if not res.success: raise RuntimeError('Tracking flow could not be solved: {:s}'.format(res.message))
+    flow = np.round(res.x).astype(np.int64)
+
+    kept = np.where(flow[:nlink] > 0)[0]
+    for k in range(len(pairs)):
+        sel = kept[np.logical_and(src[kept] >= offsets[k],src[kept] < offsets[k+1])]
+        matches = np.empty(counts[k],dtype=object)
+        for l in range(counts[k]): matches[l] = []
+        for e in sel: matches[src[e]-offsets[k]].append(int(dst[e]-offsets[k+1]))
+        for l in range(counts[k]): matches[l].sort()
+        np.save('{:s}{:s}_f{:s}_to_{:s}'.format(config['LOOP_TRACKING_PATH'],config['LOOP_TRACKING_PREFIX'],pairs[k][0],pairs[k][1]),matches)
+    summary = {'links':len(kept)}
+    for k,name in enumerate(['births','deaths','splits','merges']): summary[name] = int(np.sum(flow[nlink+(k+1)*N:nlink+(k+2)*N]))
+    if verbose: print('Kept {:d} links, with {:d} births, {:d} deaths, {:d} splits and {:d} merges'.format(summary['links'],summary['births'],summary['deaths'],summary['splits'],summary['merges']))
+    return summary
+
+#Pairs the structures of file numbers fname[0] and fname[1], loading both (see pairTasks to stream a whole sequence)
+def worker(fname,config):
+    this = loadSnapshot(config,fname[0])
+    nxt = loadSnapshot(config,fname[1])
+    matchSnapshots(fname,this['lines'],nxt['xyz'],nxt['index'],config)
@@ -10,6 +10,8 @@ import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 import loopnet_segnet as cnn
 import loopnet_idnet as idn
+import loopnet_inference as linf
+import loopnet_features as lf
 import time
 import random
 import os
@@ -129,15 +131,11 @@ if __name__ == '__main__':
     exclude = config['SEGNET_EXCLUDE_FEATURES']
 
     tloadstart = time.time()
-    data = cnn.compileData(['{:s}{:s}_f{:08d}.npy'.format(datadir,data_pref,d) for d in files],verbose=False,exclude=exclude)
+    iddata,data,rawdata = lf.compileViews(['{:s}{:s}_f{:08d}.npy'.format(datadir,data_pref,d) for d in files],idnet_exclude=config['IDNET_EXCLUDE_FEATURES'],segnet_exclude=exclude)
     
     idnet = idn.Net()
-    iddata = idn.compileData(['{:s}{:s}_f{:08d}.npy'.format(datadir,data_pref,d) for d in files],verbose=False,exclude=config['IDNET_EXCLUDE_FEATURES'])
     idnet.load_state_dict(torch.load(config['IDNET_NAME']))
-    scores = np.zeros(np.shape(data)[0])
-    for k in range(np.shape(data)[0]):
-        output = idnet(torch.from_numpy(np.expand_dims(iddata[k,:,:],axis=0)).float()).detach().numpy()[0]
-        scores[k] = output[1]
+    scores = linf.idnetScores(idnet,iddata,config['INFERENCE_BATCH_SIZE'])
     ididx = np.where(scores>idnthresh)[0]
     data = data[ididx,:,:]
 